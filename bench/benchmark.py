@@ -0,0 +1,170 @@
+"""Benchmarks the backup and calList against the fake server of fakeserver.py.
+
+    python bench/benchmark.py --files 2000 --latency 0.02 --set WORKERS=16 --set FLAT_LISTING=False
+    python bench/benchmark.py --calendar --users 500 --set AUDIT=True
+
+The fake server runs in its own process, so that the peak RSS is that of the backup. The backup
+runs in a temporary directory. It is run again --reruns times after --changes files changed, to
+measure incremental runs. --set NAME=VALUE sets a configuration constant of main.py, or of
+calList.py with --calendar, VALUE is a Python expression. Worker processes of PROCESSES > 1 do not
+see these settings. --json prints the reports as JSON lines, to track regressions.
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fakeserver import FakeCredentials, FakeDomain, FakeDrive, FakeServer
+
+
+def serve(args, conn):
+    """Runs in the server process."""
+    drive = FakeDrive(files=args.files, depth=args.depth, fanout=args.fanout, fileSize=args.file_size,
+                      shortcutRatio=args.shortcut_ratio, docRatio=args.doc_ratio, drives=args.drives)
+    domain = FakeDomain(users=args.users, ownCalendars=args.own_calendars, shared=args.shared,
+                        maxEvents=args.max_events)
+    server = FakeServer(drive, domain, latency=args.latency, errorRate=args.error_rate,
+                        throttleRate=args.throttle_rate)
+    conn.send(server.url)
+    server.serve_forever()
+
+
+def control(url, path):
+    with urllib.request.urlopen(url + path) as resp:
+        return json.load(resp)
+
+
+def peakRss():
+    """The peak RSS in MB of this process and of its worker processes."""
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+@contextlib.contextmanager
+def quiet():
+    """Sends the output of the backup, also of its worker processes, to /dev/null."""
+    sys.stdout.flush()
+    saved = os.dup(1)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        with open(os.devnull, "w") as f, contextlib.redirect_stdout(f):
+            yield
+    finally:
+        os.dup2(saved, 1)
+        os.close(saved)
+        os.close(devnull)
+
+
+def configure(module, settings):
+    for setting in settings:
+        name, _, value = setting.partition("=")
+        if not hasattr(module, name):
+            raise SystemExit(f"unknown setting {name}")
+        setattr(module, name, eval(value))
+
+
+def runBackup(url, args):
+    import main
+    configure(main, args.set)
+    gdp = main.GDrivePerms(creds=FakeCredentials(), rootUrl=url)
+    with quiet():
+        main.run(gdp)
+    return gdp.metrics.counters
+
+
+def runCalList(url, args):
+    import calList
+    configure(calList, args.set)
+    with quiet():
+        calList.main(FakeCredentials("admin@example.com"), url)
+
+
+def measure(name, url, fn, args, unit):
+    control(url, "_reset")
+    start = time.perf_counter()
+    result = fn(url, args)
+    elapsed = time.perf_counter() - start
+    stats = control(url, "_stats")
+    calls = sum(stats["calls"].values())
+    items = stats[unit]
+    report = {
+        "run": name,
+        unit: items,
+        "seconds": round(elapsed, 3),
+        "calls": calls,
+        f"callsPer{unit[:-1].capitalize()}": round(calls / max(items, 1), 3),
+        f"{unit}PerSecond": round(items / elapsed, 1),
+        "bytesPerSecond": round(stats["bytes"] / elapsed),
+        "peakRssMb": round(peakRss(), 1),
+        "endpoints": stats["calls"],
+    }
+    if isinstance(result, dict):
+        report["stats"] = dict(result)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        print(f"{name}: {items} {unit} in {elapsed:.2f}s, {calls} calls, {report[f'callsPer{unit[:-1].capitalize()}']} "
+              f"calls per {unit[:-1]}, {report[f'{unit}PerSecond']} {unit}/s, "
+              f"{report['bytesPerSecond'] / 1e6:.2f} MB/s, peak RSS {report['peakRssMb']} MB")
+        for endpoint, n in sorted(stats["calls"].items()):
+            print(f"    {endpoint} {n}")
+        if isinstance(result, dict):
+            print("   ", ", ".join(f"{k} {v}" for k, v in sorted(result.items())))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the backup or calList against a fake server.")
+    parser.add_argument("--calendar", action="store_true", help="benchmark calList instead of the backup")
+    parser.add_argument("--files", type=int, default=1000, help="files per drive")
+    parser.add_argument("--depth", type=int, default=3, help="folder depth")
+    parser.add_argument("--fanout", type=int, default=4, help="subfolders per folder")
+    parser.add_argument("--file-size", type=int, default=20000, help="bytes per file")
+    parser.add_argument("--shortcut-ratio", type=float, default=0.05)
+    parser.add_argument("--doc-ratio", type=float, default=0.2)
+    parser.add_argument("--drives", type=int, default=2, help="shared drives")
+    parser.add_argument("--users", type=int, default=100, help="users of the domain")
+    parser.add_argument("--own-calendars", type=int, default=1, help="secondary calendars per user")
+    parser.add_argument("--shared", type=int, default=3, help="calendars of others per user")
+    parser.add_argument("--max-events", type=int, default=100, help="events per calendar")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per request")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests failing with 5xx")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of requests failing with 429")
+    parser.add_argument("--changes", type=int, default=10, help="files changed before each rerun")
+    parser.add_argument("--reruns", type=int, default=1, help="incremental runs after the full run")
+    parser.add_argument("--set", action="append", default=[], metavar="NAME=VALUE")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.get_context("spawn").Process(target=serve, args=(args, child), daemon=True)
+    server.start()
+    url = parent.recv()
+    workdir = tempfile.mkdtemp(prefix="bench")
+    os.chdir(workdir)
+    try:
+        if args.calendar:
+            measure("calList", url, runCalList, args, "users")
+        else:
+            measure("full", url, runBackup, args, "files")
+            for i in range(args.reruns):
+                control(url, f"_change?n={args.changes}")
+                measure(f"rerun{i + 1}", url, runBackup, args, "files")
+    finally:
+        server.terminate()
+        if not args.json:
+            print("Backup in", workdir)
+
+
+if __name__ == '__main__':
+    main()
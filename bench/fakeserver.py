@@ -0,0 +1,502 @@
+"""Local fake of the Google APIs the backup and calList use, for benchmarks and load tests.
+
+Serves a generated Drive (My Drive and shared drives) and a generated Workspace domain with
+calendars over HTTP, with optional latency and injected rate limit (429) and server (5xx)
+errors. It implements just enough of Drive v3, Admin Directory v1 and Calendar v3 for
+main.GDrivePerms and calList, including batch requests and Range downloads.
+
+    fake = FakeDrive(files=1000)
+    server = FakeServer(fake, FakeDomain(users=50), latency=0.01).start()
+    gdp = GDrivePerms(creds=FakeCredentials(), rootUrl=server.url)
+"""
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from google.auth.credentials import AnonymousCredentials
+
+FOLDER = "application/vnd.google-apps.folder"
+SHORTCUT = "application/vnd.google-apps.shortcut"
+DOC = "application/vnd.google-apps.document"
+
+
+class FakeCredentials(AnonymousCredentials):
+    """Credentials for the fake server, which takes the bearer token for the user's email."""
+
+    def __init__(self, subject="me@example.com"):
+        super().__init__()
+        self.subject = subject
+
+    def apply(self, headers, token=None):
+        headers["authorization"] = f"Bearer {self.subject}"
+
+    def before_request(self, request, method, url, headers):
+        self.apply(headers)
+
+    def with_subject(self, subject):
+        return FakeCredentials(subject)
+
+
+class FakeDrive:
+    """A generated My Drive and `drives` shared drives.
+
+    Every drive has a complete folder tree of the given depth and fanout, and `files` files in
+    random folders, of which shortcutRatio are shortcuts to other files and docRatio Google Docs
+    files, the rest are binary files of fileSize bytes.
+    """
+
+    def __init__(self, files=300, depth=3, fanout=4, fileSize=2000, shortcutRatio=0.05, docRatio=0.2,
+                 drives=2, seed=1):
+        self.rng = random.Random(seed)
+        self.files = {}
+        self.content = {}
+        self.drives = []
+        # ids of the changed files, the page tokens of the changes API are indexes into it
+        self.changes = []
+        self.lock = threading.Lock()
+        self.nextId = 0
+        self.time = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.rootId = self.newId("root")
+        for d in range(drives + 1):
+            if d == 0:
+                rootId = self.rootId
+            else:
+                rootId = self.newId("drive")
+                self.drives.append({"id": rootId, "name": f"Drive {d}", "kind": "drive#drive"})
+            driveId = None if d == 0 else rootId
+            folders = [rootId]
+            level = [rootId]
+            for _ in range(depth):
+                nxt = []
+                for parent in level:
+                    for _ in range(fanout):
+                        f = self.add(f"folder{len(folders)}", FOLDER, parent, driveId=driveId)
+                        nxt.append(f["id"])
+                        folders.append(f["id"])
+                level = nxt
+            created = []
+            for i in range(files):
+                parent = self.rng.choice(folders)
+                r = self.rng.random()
+                if r < shortcutRatio and created:
+                    target = self.rng.choice(created)
+                    self.add(f"sc{i}", SHORTCUT, parent, driveId=driveId,
+                             shortcutDetails={"targetId": target["id"], "targetMimeType": target["mimeType"]})
+                elif r < shortcutRatio + docRatio:
+                    created.append(self.add(f"doc{i}", DOC, parent, driveId=driveId))
+                else:
+                    created.append(self.add(f"file{i}.bin", "application/octet-stream", parent, driveId=driveId,
+                                            size=fileSize))
+        self.changes = []
+
+    def newId(self, prefix):
+        self.nextId += 1
+        return f"{prefix}{self.nextId:06d}"
+
+    def tick(self):
+        self.time += timedelta(seconds=61)
+        return self.time.isoformat().replace("+00:00", ".000Z")
+
+    def add(self, name, mimeType, parent, driveId=None, size=None, **extra):
+        fid = self.newId("f")
+        f = {"kind": "drive#file", "id": fid, "name": name, "mimeType": mimeType, "parents": [parent],
+             "modifiedTime": self.tick(), "trashed": False, "version": "1"}
+        if driveId:
+            f["driveId"] = driveId
+        f.update(extra)
+        if size is not None:
+            data = self.rng.randbytes(size)
+            self.content[fid] = data
+            f["size"] = str(size)
+            f["md5Checksum"] = hashlib.md5(data).hexdigest()
+        self.files[fid] = f
+        self.changes.append(fid)
+        return f
+
+    def update(self, fid, **kw):
+        """Changes the metadata of a file, or its content if kw has data."""
+        f = self.files[fid]
+        if "data" in kw:
+            data = kw.pop("data")
+            self.content[fid] = data
+            f["size"] = str(len(data))
+            f["md5Checksum"] = hashlib.md5(data).hexdigest()
+        f.update(kw)
+        f["modifiedTime"] = self.tick()
+        f["version"] = str(int(f["version"]) + 1)
+        self.changes.append(fid)
+
+    def export(self, fid, mimeType):
+        f = self.files[fid]
+        return f"{f['name']} {f['modifiedTime']} as {mimeType}\n".encode() * 50
+
+
+class FakeDomain:
+    """A generated Workspace domain of `users` users with their calendars.
+
+    Every user owns a primary calendar and `ownCalendars` secondary ones, and sees `shared`
+    calendars of other users as reader, as well as the holiday calendar nobody in the domain owns.
+    Every calendar has up to maxEvents events.
+    """
+
+    def __init__(self, users=20, ownCalendars=1, shared=3, maxEvents=100, domain="example.com", seed=1):
+        rng = random.Random(seed)
+        self.users = [f"user{i:05d}@{domain}" for i in range(users)]
+        # calendar id -> calendar, user -> [(calendar id, access role)]
+        self.calendars = {}
+        self.calendarList = {}
+        holidays = "en.german#holiday@group.v.calendar.google.com"
+        self.calendars[holidays] = {"id": holidays, "summary": "Holidays", "owner": None,
+                                    "events": 20, "acl": []}
+        for user in self.users:
+            own = [user] + [f"c{i}_{user.split('@')[0]}@group.calendar.google.com" for i in range(ownCalendars)]
+            for calId in own:
+                self.calendars[calId] = {"id": calId, "summary": calId.split("@")[0], "owner": user,
+                                         "events": rng.randrange(maxEvents + 1), "acl": [(user, "owner")]}
+            self.calendarList[user] = [(calId, "owner") for calId in own] + [(holidays, "reader")]
+        owned = [c for c in self.calendars.values() if c["owner"] is not None]
+        for user in self.users:
+            others = [c for c in rng.sample(owned, min(shared + ownCalendars + 1, len(owned)))
+                      if c["owner"] != user]
+            for cal in others[:shared]:
+                self.calendarList[user].append((cal["id"], "reader"))
+                cal["acl"].append((user, "reader"))
+
+
+def page(items, qs, key, defaultSize=100):
+    """The page of items selected by the pageToken and maxResults or pageSize parameters."""
+    start = int(qs.get("pageToken") or 0)
+    size = int(qs.get("maxResults") or qs.get("pageSize") or defaultSize)
+    res = {key: items[start:start + size]}
+    if start + size < len(items):
+        res["nextPageToken"] = str(start + size)
+    return res
+
+
+class Query:
+    """Evaluates the Drive search query language, as far as the backup uses it."""
+    tokenRe = re.compile(r"\s*(\(|\)|'(?:[^'\\]|\\.)*'|!=|<=|>=|=|<|>|\w+)")
+
+    def __init__(self, q, aliases=None):
+        self.tokens = self.tokenRe.findall(q or "")
+        self.pos = 0
+        # e.g. "root" -> the id of the My Drive folder
+        self.aliases = aliases or {}
+
+    def peek(self):
+        return self.tokens[self.pos].lower() if self.pos < len(self.tokens) else None
+
+    def take(self):
+        t = self.tokens[self.pos]
+        self.pos += 1
+        return t
+
+    def parse(self):
+        if not self.tokens:
+            return lambda f: True
+        return self.parseOr()
+
+    def parseOr(self):
+        left = self.parseAnd()
+        while self.peek() == "or":
+            self.take()
+            right = self.parseAnd()
+            left = (lambda a, b: lambda f: a(f) or b(f))(left, right)
+        return left
+
+    def parseAnd(self):
+        left = self.parseNot()
+        while self.peek() == "and":
+            self.take()
+            right = self.parseNot()
+            left = (lambda a, b: lambda f: a(f) and b(f))(left, right)
+        return left
+
+    def parseNot(self):
+        if self.peek() == "not":
+            self.take()
+            inner = self.parseNot()
+            return lambda f: not inner(f)
+        if self.peek() == "(":
+            self.take()
+            inner = self.parseOr()
+            self.take()
+            return inner
+        return self.parseTerm()
+
+    def value(self, t):
+        if t.startswith("'"):
+            return t[1:-1].replace("\\'", "'")
+        return {"true": True, "false": False}.get(t.lower(), t)
+
+    def parseTerm(self):
+        a = self.take()
+        op = self.take()
+        b = self.take()
+        if op.lower() == "in":
+            val, field = self.value(a), b
+            val = self.aliases.get(val, val)
+            if field == "parents":
+                return lambda f: val in f.get("parents", [])
+            if field == "owners":
+                return lambda f: True
+            raise ValueError(field)
+        field, val = a, self.value(b)
+        if op.lower() == "contains":
+            return lambda f: val in f.get(field, "")
+        ops = {"=": lambda x, y: x == y, "!=": lambda x, y: x != y, ">": lambda x, y: x > y,
+               "<": lambda x, y: x < y, ">=": lambda x, y: x >= y, "<=": lambda x, y: x <= y}
+        fn = ops[op]
+        return lambda f: f.get(field) is not None and fn(f.get(field), val)
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body, ctype="application/json", headers=None):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(body)))
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send(*self.server.handle("GET", self.path, {k.lower(): v for k, v in self.headers.items()}))
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length)
+        if self.path.startswith("/batch/"):
+            return self.batch(body)
+        self.send(*self.server.handle("POST", self.path, {k.lower(): v for k, v in self.headers.items()}))
+
+    def batch(self, body):
+        """Answers a multipart/mixed batch request, every part is handled like a single request."""
+        boundary = self.headers["Content-Type"].split("boundary=")[1].strip('"')
+        out = []
+        respBoundary = "batch_" + uuid.uuid4().hex
+        self.server.count("batch")
+        for part in body.split(b"--" + boundary.encode()):
+            part = part.strip()
+            if not part or part == b"--":
+                continue
+            head, _, inner = part.partition(b"\r\n\r\n")
+            if not inner:
+                head, _, inner = part.partition(b"\n\n")
+            cid = re.search(rb"Content-ID: <(.*)>", head, re.I).group(1).decode()
+            lines = inner.decode().splitlines()
+            method, path, _ = lines[0].split(" ")
+            headers = {}
+            for line in lines[1:]:
+                if not line.strip():
+                    break
+                k, _, v = line.partition(":")
+                headers[k.strip().lower()] = v.strip()
+            status, payload, rtype, _ = self.server.handle(method, path, headers)
+            if isinstance(payload, (dict, list)):
+                payload = json.dumps(payload)
+            elif isinstance(payload, bytes):
+                payload = payload.decode("latin-1")
+            out.append(f"--{respBoundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{cid}>\r\n\r\n"
+                       f"HTTP/1.1 {status} X\r\nContent-Type: {rtype}\r\nContent-Length: {len(payload)}\r\n\r\n"
+                       f"{payload}\r\n")
+        out.append(f"--{respBoundary}--\r\n")
+        self.send(200, "".join(out).encode(), f"multipart/mixed; boundary={respBoundary}")
+
+
+class FakeServer(ThreadingHTTPServer):
+    """Serves drive (a FakeDrive) and domain (a FakeDomain) on 127.0.0.1.
+
+    Every request, also every part of a batch, waits `latency` seconds and fails with 429 with
+    probability throttleRate, or with 500 or 503 with probability errorRate. calls counts the
+    requests per endpoint, bytes the downloaded and exported bytes. Both can be read with
+    GET /_stats when the server runs in another process, see control.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, drive=None, domain=None, latency=0.0, errorRate=0.0, throttleRate=0.0, port=0, seed=7):
+        super().__init__(("127.0.0.1", port), Handler)
+        self.drive = drive or FakeDrive(files=0, drives=0)
+        self.domain = domain or FakeDomain(users=0)
+        self.latency = latency
+        self.errorRate = errorRate
+        self.throttleRate = throttleRate
+        self.calls = Counter()
+        self.bytes = 0
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def handle(self, method, path, headers):
+        """Returns status, body, content type and extra headers of the response."""
+        u = urlparse(path)
+        qs = {k: v[0] for k, v in parse_qs(u.query).items()}
+        p = unquote(u.path)
+        if p.startswith("/_"):
+            return self.control(p, qs)
+        if self.latency:
+            time.sleep(self.latency)
+        self.count(self.endpoint(p, qs))
+        with self.lock:
+            r = self.rng.random()
+        if r < self.throttleRate:
+            return 429, error(429, "rateLimitExceeded"), "application/json", {"Retry-After": "0"}
+        if r < self.throttleRate + self.errorRate:
+            code = self.rng.choice([500, 503])
+            return code, error(code, "backendError"), "application/json", None
+        user = headers.get("authorization", "").removeprefix("Bearer ")
+        if p.startswith("/drive/v3/"):
+            with self.drive.lock:
+                return self.routeDrive(p[len("/drive/v3/"):], qs, headers)
+        if p.startswith("/calendar/v3/"):
+            return self.routeCalendar(p[len("/calendar/v3/"):], qs, user)
+        if p == "/admin/directory/v1/users":
+            return 200, page([{"primaryEmail": u} for u in self.domain.users], qs, "users"), "application/json", None
+        return 404, error(404, "notFound"), "application/json", None
+
+    def control(self, p, qs):
+        """The endpoints of the benchmark: /_stats returns the counters, /_reset clears them and
+        /_change?n=<n> changes the content of n random files."""
+        j = "application/json"
+        if p == "/_stats":
+            with self.lock:
+                files = sum(f["mimeType"] != FOLDER for f in self.drive.files.values())
+                return 200, {"calls": dict(self.calls), "bytes": self.bytes, "files": files,
+                             "users": len(self.domain.users)}, j, None
+        if p == "/_reset":
+            with self.lock:
+                self.calls.clear()
+                self.bytes = 0
+            return 200, {}, j, None
+        if p == "/_change":
+            with self.drive.lock:
+                ids = [fid for fid in self.drive.content]
+                for fid in self.rng.sample(ids, min(int(qs.get("n", 1)), len(ids))):
+                    self.drive.update(fid, data=self.rng.randbytes(len(self.drive.content[fid])))
+            return 200, {}, j, None
+        return 404, error(404, "notFound"), j, None
+
+    def endpoint(self, p, qs):
+        p = re.sub(r"/files/[^/]+", "/files/ID", p)
+        p = re.sub(r"/calendars/[^/]+", "/calendars/ID", p)
+        if qs.get("alt") == "media":
+            p += "?alt=media"
+        return p
+
+    def routeDrive(self, p, qs, headers):
+        fake = self.drive
+        j = "application/json"
+        if p == "drives":
+            return 200, page(fake.drives, qs, "drives"), j, None
+        if p == "about":
+            return 200, {"user": {"emailAddress": "me@example.com"}}, j, None
+        if p == "changes/startPageToken":
+            return 200, {"startPageToken": str(len(fake.changes))}, j, None
+        if p == "changes":
+            start = int(qs["pageToken"])
+            size = int(qs.get("pageSize", 100))
+            driveId = qs.get("driveId")
+            out = []
+            for fid in fake.changes[start:start + size]:
+                f = fake.files[fid]
+                if f.get("driveId") == driveId:
+                    out.append({"kind": "drive#change", "changeType": "file", "fileId": fid, "removed": False,
+                                "file": dict(f)})
+            res = {"changes": out}
+            if start + size < len(fake.changes):
+                res["nextPageToken"] = str(start + size)
+            else:
+                res["newStartPageToken"] = str(len(fake.changes))
+            return 200, res, j, None
+        if p == "files":
+            pred = Query(qs.get("q"), {"root": fake.rootId}).parse()
+            driveId = qs.get("driveId")
+            if qs.get("corpora") == "drive":
+                cands = [f for f in fake.files.values() if f.get("driveId") == driveId]
+            elif qs.get("corpora") == "user":
+                cands = [f for f in fake.files.values() if f.get("driveId") is None]
+            else:
+                cands = list(fake.files.values())
+            cands = sorted((dict(f) for f in cands if pred(f)), key=lambda f: f["id"])
+            return 200, page(cands, qs, "files"), j, None
+        m = re.fullmatch(r"files/([^/]+)(/export)?", p)
+        if m is None:
+            return 404, error(404, "notFound"), j, None
+        fid = m.group(1)
+        if fid == "root":
+            return 200, {"id": fake.rootId, "name": "My Drive", "mimeType": FOLDER,
+                         "owners": [{"emailAddress": "me@example.com"}]}, j, None
+        f = fake.files.get(fid)
+        if f is None:
+            return 404, error(404, "notFound"), j, None
+        if m.group(2):
+            data = fake.export(fid, qs.get("mimeType"))
+            self.bytes += len(data)
+            return 200, data, qs.get("mimeType"), None
+        if qs.get("alt") != "media":
+            return 200, dict(f), j, None
+        data = fake.content[fid]
+        rng = headers.get("range")
+        if not rng:
+            self.bytes += len(data)
+            return 200, data, "application/octet-stream", None
+        a, b = rng.split("=")[1].split("-")
+        a, b = int(a), min(int(b or len(data) - 1), len(data) - 1)
+        if a >= len(data):
+            return 416, b"", "application/octet-stream", None
+        self.bytes += b + 1 - a
+        return 206, data[a:b + 1], "application/octet-stream", {"Content-Range": f"bytes {a}-{b}/{len(data)}"}
+
+    def routeCalendar(self, p, qs, user):
+        domain = self.domain
+        j = "application/json"
+        if p == "users/me/calendarList":
+            if user not in domain.calendarList:
+                return 404, error(404, "notFound"), j, None
+            items = [{"id": calId, "summary": domain.calendars[calId]["summary"], "accessRole": role}
+                     for calId, role in domain.calendarList[user]]
+            return 200, page(items, qs, "items"), j, None
+        m = re.fullmatch(r"calendars/([^/]+)(/acl|/events)?", p)
+        cal = domain.calendars.get(m.group(1)) if m else None
+        if cal is None:
+            return 404, error(404, "notFound"), j, None
+        if m.group(2) is None:
+            return 200, {"id": cal["id"], "summary": cal["summary"], "dataOwner": cal["owner"]}, j, None
+        if m.group(2) == "/acl":
+            if (user, "owner") not in cal["acl"]:
+                return 403, error(403, "forbidden"), j, None
+            items = [{"role": role, "scope": {"type": "user", "value": u}} for u, role in cal["acl"]]
+            return 200, page(items, qs, "items"), j, None
+        items = [{"id": f"e{i}"} for i in range(cal["events"])]
+        return 200, page(items, qs, "items", 250), j, None
+
+
+def error(code, reason):
+    return {"error": {"code": code, "message": reason, "errors": [{"reason": reason}]}}
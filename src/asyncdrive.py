@@ -0,0 +1,322 @@
+import asyncio
+import contextlib
+import os
+import time
+
+import aiohttp
+import google.auth.transport.requests
+
+from retry import isRetryable, isThrottled, retryDelay
+
+FOLDER = "application/vnd.google-apps.folder"
+
+
+class DriveError(Exception):
+    def __init__(self, status, message, retryAfter=None):
+        super().__init__(f"HTTP {status}: {message}")
+        self.status = status
+        self.body = message.encode(errors="replace")
+        self.retryAfter = retryAfter
+
+
+class AdaptiveLimiter:
+    """asyncio version of retry.AdaptiveLimiter, for the tasks of one event loop.
+
+    The limit is halved after a throttling response and grows by one after `increaseAfter`
+    successful requests, up to maxLimit.
+    """
+
+    def __init__(self, maxLimit, increaseAfter=20):
+        self.maxLimit = maxLimit
+        self.limit = maxLimit
+        self.increaseAfter = increaseAfter
+        self.active = 0
+        self.successes = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            await self.cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def release(self, throttled):
+        async with self.cond:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.increaseAfter and self.limit < self.maxLimit:
+                    self.limit += 1
+                    self.successes = 0
+            self.cond.notify_all()
+
+
+class AsyncDrive:
+    """asyncio client for the Drive v3 endpoints the backup uses.
+
+    All requests share one aiohttp session with a pool of at most `connections` keep-alive
+    connections, at most `inFlight` requests are outstanding at a time. Like retry.Executor,
+    requests take a token from the optional ratelimit.TokenBucket bucket and a slot from an
+    AdaptiveLimiter, which lowers the number of outstanding requests after throttling responses.
+    baseUrl can point to a local fake Drive server, creds may then be None.
+    Rate limit, server and network errors are retried up to maxRetries times like retry.Executor
+    does, count(name) is called for every retry, count("bytes", n) with the bytes received by
+    downloads, observe(endpoint, seconds) for every request.
+    A connection attempt times out after connectTimeout seconds, a request that receives nothing for
+    readTimeout seconds is retried; a long download is not limited as long as data arrives.
+    """
+
+    def __init__(self, creds, baseUrl="https://www.googleapis.com/drive/v3/", connections=8, inFlight=64,
+                 maxRetries=8, count=None, observe=None, connectTimeout=30, readTimeout=60, bucket=None):
+        self.creds = creds
+        self.baseUrl = baseUrl
+        self.connections = connections
+        self.limiter = AdaptiveLimiter(inFlight)
+        self.bucket = bucket
+        self.maxRetries = maxRetries
+        self.count = count or (lambda name, n=1: None)
+        self.observe = observe or (lambda endpoint, seconds: None)
+        self.timeout = aiohttp.ClientTimeout(total=None, sock_connect=connectTimeout, sock_read=readTimeout)
+        self.session = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.connections, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.session.close()
+
+    async def headers(self):
+        headers = {}
+        if self.creds is not None:
+            if not self.creds.valid:
+                # refreshing blocks, keep it out of the event loop
+                await asyncio.to_thread(self.creds.refresh, google.auth.transport.requests.Request())
+            self.creds.apply(headers)
+        return headers
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        """Waits for a token and a slot of the limiter for a request, released when it is done."""
+        if self.bucket is not None:
+            await self.bucket.acquireAsync()
+        await self.limiter.acquire()
+        throttled = False
+        try:
+            yield
+        except DriveError as e:
+            throttled = isThrottled(e.status, e.body)
+            raise
+        finally:
+            await self.limiter.release(throttled)
+
+    async def retry(self, attempt, endpoint, error):
+        """Waits before retrying a failed request, re-raises error if it is not worth retrying."""
+        if isinstance(error, DriveError):
+            if not isRetryable(error.status, error.body) or attempt >= self.maxRetries:
+                raise error
+            delay = retryDelay(attempt, error.retryAfter)
+        else:
+            if attempt >= self.maxRetries:
+                raise error
+            delay = retryDelay(attempt)
+        self.count(f"retries {endpoint}")
+        await asyncio.sleep(delay)
+
+    async def getJson(self, path, endpoint, **params):
+        """Requests path, endpoint is its name in the metrics, the methodId of googleapiclient."""
+        params = {k: str(v).lower() if isinstance(v, bool) else v for k, v in params.items() if v is not None}
+        attempt = 0
+        while True:
+            try:
+                async with self.slot():
+                    start = time.monotonic()
+                    try:
+                        async with self.session.get(self.baseUrl + path, params=params,
+                                                    headers=await self.headers()) as resp:
+                            if resp.status >= 400:
+                                raise DriveError(resp.status, await resp.text(), resp.headers.get("Retry-After"))
+                            return await resp.json(content_type=None)
+                    finally:
+                        self.observe(endpoint, time.monotonic() - start)
+            except (DriveError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await self.retry(attempt, endpoint, e)
+            attempt += 1
+
+    async def download(self, path, endpoint, fileObj, offset=0, chunkSize=1024 * 1024, ranged=True, **params):
+        """Streams the response body of path into fileObj, starting at offset with a Range request.
+
+        A retried download continues where the failed one stopped if ranged, else it starts over.
+        """
+        begin = fileObj.tell()
+        size = 0
+        attempt = 0
+        while True:
+            headers = await self.headers()
+            if offset + size:
+                headers["Range"] = f"bytes={offset + size}-"
+            try:
+                async with self.slot():
+                    start = time.monotonic()
+                    try:
+                        async with self.session.get(self.baseUrl + path, params=params, headers=headers) as resp:
+                            if resp.status >= 400:
+                                raise DriveError(resp.status, await resp.text(), resp.headers.get("Retry-After"))
+                            async for chunk in resp.content.iter_chunked(chunkSize):
+                                fileObj.write(chunk)
+                                size += len(chunk)
+                                self.count("bytes", len(chunk))
+                            return size
+                    finally:
+                        self.observe(endpoint, time.monotonic() - start)
+            except (DriveError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                await self.retry(attempt, endpoint, e)
+            if not ranged:
+                fileObj.seek(begin)
+                fileObj.truncate()
+                size = 0
+            attempt += 1
+
+    async def filesList(self, **params):
+        return await self.getJson("files", "drive.files.list", **params)
+
+    async def filesGet(self, fileId, **params):
+        return await self.getJson(f"files/{fileId}", "drive.files.get", **params)
+
+    async def getMedia(self, fileId, fileObj, offset=0, chunkSize=1024 * 1024):
+        return await self.download(f"files/{fileId}", "drive.files.get_media", fileObj, offset, chunkSize, alt="media")
+
+    async def exportMedia(self, fileId, mimeType, fileObj, chunkSize=1024 * 1024):
+        return await self.download(f"files/{fileId}/export", "drive.files.export", fileObj, 0, chunkSize,
+                                   ranged=False, mimeType=mimeType)
+
+    async def drivesList(self, **params):
+        return await self.getJson("drives", "drive.drives.list", **params)
+
+    async def changesList(self, **params):
+        return await self.getJson("changes", "drive.changes.list", **params)
+
+    async def listAll(self, method, key, **params):
+        """Fetches all pages of a list method, returns the concatenated `key` items."""
+        res = []
+        pageToken = None
+        while True:
+            results = await method(pageToken=pageToken, **params)
+            res.extend(results.get(key, []))
+            pageToken = results.get("nextPageToken")
+            if pageToken is None:
+                return res
+
+
+async def backupDrive(gdp, drive, driveId, drvPath, fields, pageSize, workers=16, queueSize=256):
+    """Backs up a drive like GDrivePerms.listFiles, but with the asyncio client `drive`.
+
+    Every folder is listed by its own task, and downloads run in `workers` tasks fed by a bounded
+    queue, so the listing cannot run ahead of the downloads by more than queueSize files.
+    The skip decisions and the bookkeeping are done by gdp.
+    """
+    queue = asyncio.Queue(queueSize)
+    # handleFile and resolveShortcuts of gdp collect the downloads in gdp.jobs
+    gdp.jobs = []
+
+    async def flushJobs():
+        jobs, gdp.jobs = gdp.jobs, []
+        for job in jobs:
+            await queue.put(job)
+            gdp.metrics.gauge("downloads queued", queue.qsize())
+
+    async def listFolder(folderId, path):
+        if driveId is not None and folderId == driveId:
+            params = dict(driveId=driveId, corpora="drive", includeItemsFromAllDrives=True, supportsAllDrives=True)
+        else:
+            params = dict(includeItemsFromAllDrives=True, supportsAllDrives=True)
+        try:
+            files = await drive.listAll(drive.filesList, "files", q=gdp.rules.query(f"'{folderId}' in parents"),
+                                        fields=f"nextPageToken,files({fields})", pageSize=pageSize, **params)
+        except Exception as e:
+            # the other folders are walked on, the next run walks the drive again
+            gdp.walkFailed(path, e)
+            return
+        files.sort(key=lambda x: x.get("name"))
+        gdp.makeDir(path)
+        subTasks = []
+        for file in files:
+            fpath = path + gdp.normalize(file["name"])
+            if file["mimeType"] == FOLDER:
+                fpath += "/"
+                if not gdp.rules.walkDir(fpath):
+                    gdp.log("Exclude", fpath)
+                    continue
+                gdp.manifest.record(file["id"], gdp.driveKey, fpath, file, backedUp=False)
+                subTasks.append(asyncio.create_task(listFolder(file["id"], fpath)))
+            else:
+                gdp.handleFile(file, fpath)
+            await flushJobs()
+        await asyncio.gather(*subTasks)
+
+    async def resolveShortcuts():
+        shortcuts, gdp.shortcuts = gdp.shortcuts, []
+
+        async def resolve(file, fpath):
+            try:
+                target = await drive.filesGet(file["shortcutDetails"]["targetId"], fields=fields + ",trashed",
+                                              supportsAllDrives=True)
+            except DriveError as e:
+                print("ErrorSC", fpath, e)
+                gdp.fail(file["id"], fpath, e)
+                return
+            if not target.get("trashed") and target["mimeType"] != FOLDER:
+                gdp.handleFile(target, fpath, file["id"])
+            await flushJobs()
+
+        await asyncio.gather(*(resolve(file, fpath) for file, fpath in shortcuts))
+
+    async def downloader():
+        while True:
+            job = await queue.get()
+            gdp.metrics.gauge("downloads queued", queue.qsize())
+            try:
+                await downloadJob(gdp, drive, *job)
+            finally:
+                queue.task_done()
+
+    tasks = [asyncio.create_task(downloader()) for _ in range(workers)]
+    try:
+        if driveId is None:
+            root = await drive.filesGet("root", fields="id")
+            rootId = root["id"]
+        else:
+            rootId = driveId
+        await listFolder(rootId, drvPath)
+        await resolveShortcuts()
+        await queue.join()
+    finally:
+        for task in tasks:
+            task.cancel()
+        gdp.jobs = None
+
+
+async def downloadJob(gdp, drive, key, file1Info, exportType, fpath):
+    """Downloads or exports a file queued by gdp.queueDownload."""
+    try:
+        tmpPath, offset = gdp.startDownload(file1Info, exportType, fpath)
+        try:
+            with open(tmpPath, "ab" if offset else "wb") as file2:
+                if exportType is None:
+                    if not offset or offset < int(file1Info["size"]):
+                        await drive.getMedia(file1Info["id"], file2, offset)
+                else:
+                    await drive.exportMedia(file1Info["id"], exportType, file2)
+                file2.flush()
+                os.fsync(file2.fileno())
+        except BaseException:
+            gdp.abortDownload(tmpPath, exportType)
+            raise
+        gdp.log(f"{'Download' if exportType is None else 'Export'} {fpath}")
+        # checksums and compresses the whole file in CAS and pack mode, not on the event loop
+        await asyncio.to_thread(gdp.finishDownload, key, file1Info, exportType, fpath, tmpPath)
+    except Exception as e:
+        gdp.downloadFailed(key, file1Info, exportType, fpath, e)
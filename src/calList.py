@@ -1,10 +1,18 @@
 import os
 import json
 import csv
+import threading
+from contextlib import ExitStack
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
+from googleapiclient.discovery import build, build_from_document
+from googleapiclient.discovery_cache import get_static_doc
 from googleapiclient.errors import HttpError
 
+from ratelimit import TokenBucket
+from retry import Executor
+
 
 class excel2(csv.Dialect):
     """Describe the usual properties of Excel-generated CSV files."""
@@ -17,8 +25,8 @@ class excel2(csv.Dialect):
 
 
 class CsvWriter:
-    def __init__(self, f):
-        self.fieldNames = [
+    def __init__(self, f, header=True, fieldNames=None):
+        self.fieldNames = fieldNames or [
             "user",
             "id",
             "summary",
@@ -29,12 +37,34 @@ class CsvWriter:
         csv.register_dialect("excel2", excel2)
         self.writer = csv.DictWriter(
             f, self.fieldNames, dialect="excel2", extrasaction="ignore")
-        self.writer.writeheader()
+        if header:
+            self.writer.writeheader()
 
     def write(self, entry):
         self.writer.writerow(entry)
 
 
+class AuditCsvWriter(CsvWriter):
+    def __init__(self, f, header=True):
+        super().__init__(f, header, [
+            "id",
+            "data_owner",
+            "acl",
+            "event_count",
+            "error",
+        ])
+
+
+class JsonlWriter:
+    """Writes one JSON object per line."""
+
+    def __init__(self, f, header=True):
+        self.f = f
+
+    def write(self, entry):
+        self.f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+
 # --- Configuration ---
 # Path to your service account key file
 # 'path/to/your/service_account.json'
@@ -48,8 +78,63 @@ SCOPES = [
     'https://www.googleapis.com/auth/admin.directory.user.readonly',
     'https://www.googleapis.com/auth/calendar.readonly'
 ]
+
+# The output file and its format, "csv" or "jsonl"
+OUTPUT_FILE = "cal.csv"
+OUTPUT_FORMAT = "csv"
+# The users whose calendars are in OUTPUT_FILE already, one per line. A run that was interrupted
+# or could not read all users is continued by the next run, which appends to OUTPUT_FILE.
+# The file is removed when all users are done, so that the next run starts over.
+CHECKPOINT_FILE = "cal.done"
+
+# Audit mode: also write the data owner, the ACL rules and the number of events of every calendar
+# to AUDIT_FILE, one row per calendar even if it is shared with many users
+AUDIT = False
+AUDIT_FILE = "calAudit.csv"
+# Sub-requests per batch request, the Calendar API allows at most 50
+BATCH_SIZE = 50
+
+# How often a request failing with a rate limit (403/429), server (5xx) or network error is retried
+MAX_RETRIES = 8
+# Number of users whose calendars are listed in parallel
+WORKERS = 16
+# Requests per second, the Calendar API allows about 10 per user and second, and less per project
+MAX_QPS = 20
+MAX_BURST = 20
 # --- End Configuration ---
 
+executor = Executor(WORKERS, TokenBucket(MAX_QPS, MAX_BURST), MAX_RETRIES)
+# the calendars audited or being audited, and calendar id -> a user who sees the calendars
+# no user seen so far owns, see claim_calendars
+audit_lock = threading.Lock()
+audited = set()
+unowned = {}
+# the service account credentials and the Calendar discovery document, read once by loadServiceAccount
+service_account_creds = None
+calendar_doc = None
+
+
+def loadServiceAccount(creds=None, root_url=None):
+    """Reads the service account key and the Calendar API discovery document.
+
+    creds and root_url are given to run against another server, see GDrivePerms.
+    """
+    global service_account_creds, calendar_doc
+    if creds is None:
+        with open(SERVICE_ACCOUNT_FILE, encoding="utf-8") as f:
+            creds = service_account.Credentials.from_service_account_info(
+                json.load(f), scopes=SCOPES)
+    service_account_creds = creds
+    calendar_doc = json.loads(get_static_doc("calendar", "v3"))
+    if root_url:
+        # batch requests go to the rootUrl of the document, not to client_options
+        calendar_doc["rootUrl"] = root_url
+
+
+def credentials_for(user_email):
+    """Credentials impersonating user_email, sharing the parsed key of the service account."""
+    return service_account_creds.with_subject(user_email)
+
 
 def get_all_domain_users(service):
     """Fetches all users in the Google Workspace domain."""
@@ -58,12 +143,13 @@ def get_all_domain_users(service):
     print("Fetching all users from the domain...")
     while True:
         try:
-            results = service.users().list(
+            results = executor.execute(service.users().list(
                 domain=DOMAIN,
                 orderBy='email',
                 maxResults=500,  # Max allowed per page
-                pageToken=page_token
-            ).execute()
+                pageToken=page_token,
+                fields="nextPageToken,users(primaryEmail)"
+            ))
 
             users.extend(results.get('users', []))
             page_token = results.get('nextPageToken')
@@ -76,22 +162,99 @@ def get_all_domain_users(service):
     return users
 
 
+def calendar_service_for(user_email):
+    # Build a calendar service for the impersonated user from the cached discovery document.
+    # Every user gets their own service, as httplib2 is not thread-safe
+    return build_from_document(calendar_doc, credentials=credentials_for(user_email))
+
+
+def claim_calendars(user_email, rows):
+    """Returns the ids of the calendars among rows that user_email audits.
+
+    A calendar is audited once, by the first user who owns it, as only owners may read the
+    ACL. The calendars nobody in the domain owns are audited at the end, see main.
+    """
+    claimed = []
+    with audit_lock:
+        for row in rows:
+            cal_id = row["id"]
+            if cal_id in audited:
+                continue
+            if row["access_role"] == "owner":
+                audited.add(cal_id)
+                unowned.pop(cal_id, None)
+                claimed.append(cal_id)
+            else:
+                unowned.setdefault(cal_id, user_email)
+    return claimed
+
+
+def list_all(request, response, list_next):
+    """The items of response and of the following pages of the list request."""
+    items = response.get("items", [])
+    while True:
+        request = list_next(request, response)
+        if request is None:
+            return items
+        response = executor.execute(request)
+        items.extend(response.get("items", []))
+
+
+def audit_calendars(calendar_service, cal_ids, with_acl=True):
+    """Fetches data owner, ACL rules and event count of the calendars cal_ids, returns their audit rows.
+
+    The first page of every list is fetched with batch requests, only calendars with more
+    than 2500 events or 250 ACL rules need further requests.
+    """
+    calendars = calendar_service.calendars()
+    acl = calendar_service.acl()
+    events = calendar_service.events()
+    requests = {}
+    for i, cal_id in enumerate(cal_ids):
+        requests[f"get{i}"] = lambda cal_id=cal_id: calendars.get(
+            calendarId=cal_id, fields="id,dataOwner")
+        if with_acl:
+            requests[f"acl{i}"] = lambda cal_id=cal_id: acl.list(
+                calendarId=cal_id, maxResults=250, fields="nextPageToken,items(role,scope)")
+        requests[f"events{i}"] = lambda cal_id=cal_id: events.list(
+            calendarId=cal_id, maxResults=2500, fields="nextPageToken,items(id)")
+    responses, errors = executor.executeBatch(
+        lambda callback: calendar_service.new_batch_http_request(callback=callback),
+        requests, BATCH_SIZE, MAX_RETRIES)
+
+    rows = []
+    for i, cal_id in enumerate(cal_ids):
+        row = {"id": cal_id, "data_owner": "", "acl": "", "event_count": "", "error": ""}
+        failed = [f"{kind}: {errors[kind + str(i)]}" for kind in ("get", "acl", "events") if kind + str(i) in errors]
+        try:
+            if f"get{i}" in responses:
+                row["data_owner"] = responses[f"get{i}"].get("dataOwner", "")
+            if f"acl{i}" in responses:
+                rules = list_all(requests[f"acl{i}"](), responses[f"acl{i}"], acl.list_next)
+                row["acl"] = " ".join(f"{rule['scope'].get('value', rule['scope']['type'])}:{rule['role']}"
+                                      for rule in rules)
+            if f"events{i}" in responses:
+                row["event_count"] = len(list_all(requests[f"events{i}"](), responses[f"events{i}"], events.list_next))
+        except HttpError as error:
+            failed.append(str(error.reason))
+        row["error"] = "; ".join(failed)
+        rows.append(row)
+    return rows
+
+
 def get_calendars_for_user(user_email):
-    """Lists all calendars for a single, impersonated user."""
-    try:
-        # Create new credentials impersonating the user
-        impersonated_creds = service_account.Credentials.from_service_account_file(
-            SERVICE_ACCOUNT_FILE, scopes=SCOPES).with_subject(user_email)
+    """Lists all calendars for a single, impersonated user, returns None if that failed.
 
-        # Build a new calendar service for the impersonated user
-        calendar_service = build(
-            'calendar', 'v3', credentials=impersonated_creds)
+    In audit mode it returns the calendar rows and the audit rows of the calendars this user audits.
+    """
+    try:
+        calendar_service = calendar_service_for(user_email)
 
         page_token = None
         rows = []
         while True:
-            calendar_list = calendar_service.calendarList().list(
-                pageToken=page_token).execute()
+            calendar_list = executor.execute(calendar_service.calendarList().list(
+                pageToken=page_token))
             for calendar_list_entry in calendar_list.get('items', []):
                 # print(json.dumps(calendar_list_entry))
                 access_role = calendar_list_entry.get(
@@ -108,8 +271,6 @@ def get_calendars_for_user(user_email):
                     "access_role": access_role,
                 }
                 rows.append(row)
-                print(
-                    f"  - Summary:'{summary}' Description: '{description}' AccessRole:{access_role} ID:{cal_id}")
                 # cal_resource = calendar_service.calendars().get(calendarId=cal_id).execute()
                 # # print(json.dumps(cal_resource, indent=2))
                 # assert (cal_resource.get('summary', 'No Summary') == summary)
@@ -121,32 +282,60 @@ def get_calendars_for_user(user_email):
             page_token = calendar_list.get('nextPageToken')
             if not page_token:
                 break
+        if AUDIT:
+            return rows, audit_calendars(calendar_service, claim_calendars(user_email, rows))
         return rows
     except HttpError as error:
         # Common errors include a user not having Calendar enabled.
-        print(f"  - Could not retrieve calendars. Error: {error.reason}")
-        return []
+        print(f"  - Could not retrieve calendars of {user_email}. Error: {error.reason}")
+        return None
     except Exception as e:
-        print(f"  - An unexpected error occurred: {e}")
+        print(f"  - An unexpected error occurred for {user_email}: {e}")
+        return None
+
+
+def open_output(stack, path, writer_class, resume):
+    """Opens path for writing, or for appending if resume, and returns the file and a writer of
+    OUTPUT_FORMAT, writer_class for CSV."""
+    encoding = "utf-8-sig" if OUTPUT_FORMAT == "csv" and not resume else "utf-8"
+    f = stack.enter_context(open(path, "a" if resume else "w", encoding=encoding))
+    return f, (writer_class if OUTPUT_FORMAT == "csv" else JsonlWriter)(f, header=not resume)
+
+
+def audited_calendars():
+    """The ids of the calendars in AUDIT_FILE."""
+    if not os.path.exists(AUDIT_FILE):
+        return set()
+    with open(AUDIT_FILE, encoding="utf-8-sig") as f:
+        if OUTPUT_FORMAT == "csv":
+            return {row["id"] for row in csv.DictReader(f, dialect=excel2)}
+        return {json.loads(line)["id"] for line in f if line.strip()}
+
+
+def audit_unowned(user_email, cal_ids):
+    try:
+        return audit_calendars(calendar_service_for(user_email), cal_ids, with_acl=False)
+    except Exception as e:
+        print(f"  - Audit failed for {user_email}: {e}")
         return []
 
 
-def main():
+def main(creds=None, root_url=None):
     """
     Main function to enumerate all calendars for all users in a domain.
     """
     # 1. Authenticate as the service account to use the Admin SDK
-    admin_creds = service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=SCOPES)
+    loadServiceAccount(creds, root_url)
 
     # Note: The Admin SDK requires a subject to impersonate, even for domain-level tasks.
     # You must use the email of an admin user in your domain.
     admin_user_email = 'michael.uhlenberg.admin@adfc-muenchen.de'  # CHANGE THIS
-    delegated_admin_creds = admin_creds.with_subject(admin_user_email)
+    delegated_admin_creds = credentials_for(admin_user_email)
 
     try:
         admin_service = build('admin', 'directory_v1',
-                              credentials=delegated_admin_creds)
+                              credentials=delegated_admin_creds,
+                              client_options={"api_endpoint": root_url} if root_url else None)
     except Exception as e:
         print(
             f"Failed to build Admin SDK service. Check your credentials and scopes. Error: {e}")
@@ -158,18 +347,78 @@ def main():
         print("No users found or an error occurred. Exiting.")
         return
 
-    # 3. Iterate through each user and list their calendars
-    rows = []
-    for user in users:
-        user_email = user['primaryEmail']
-        print(f"\nProcessing calendars for user: {user_email}")
-        rows.extend(get_calendars_for_user(user_email))
-
-    with open("cal.csv", "w", encoding="utf-8-sig") as csvOutfile:
-        csvWriter = CsvWriter(csvOutfile)
-        for row in rows:
-            csvWriter.write(row)
-    print("Ausgabedatei geschrieben, ", len(rows), "Einträge")
+    # 3. Skip the users done by an interrupted earlier run
+    done = set()
+    if os.path.exists(CHECKPOINT_FILE) and os.path.exists(OUTPUT_FILE):
+        with open(CHECKPOINT_FILE, encoding="utf-8") as f:
+            done = {line.strip() for line in f if line.strip()}
+        print("Fortsetzung,", len(done), "Benutzer schon erledigt")
+    todo = [user['primaryEmail'] for user in users if user['primaryEmail'] not in done]
+
+    if AUDIT and done:
+        audited.update(audited_calendars())
+
+    # 4. List the calendars of WORKERS users at a time, write them as they arrive
+    count = 0
+    failed = []
+    resume = bool(done)
+    with ExitStack() as stack:
+        outfile, writer = open_output(stack, OUTPUT_FILE, CsvWriter, resume)
+        if AUDIT:
+            auditfile, audit_writer = open_output(stack, AUDIT_FILE, AuditCsvWriter,
+                                                  resume and os.path.exists(AUDIT_FILE))
+        checkpoint = stack.enter_context(open(CHECKPOINT_FILE, "a" if resume else "w", encoding="utf-8"))
+        pool = stack.enter_context(ThreadPoolExecutor(max_workers=WORKERS))
+        # at most 2 * WORKERS users are queued or finished but not written, so that the memory
+        # does not grow with the size of the domain
+        pending = {}
+        users = iter(todo)
+        while True:
+            for user_email in users:
+                pending[pool.submit(get_calendars_for_user, user_email)] = user_email
+                if len(pending) >= 2 * WORKERS:
+                    break
+            if not pending:
+                break
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in finished:
+                user_email = pending.pop(future)
+                user_rows = future.result()
+                if user_rows is None:
+                    failed.append(user_email)
+                    continue
+                if AUDIT:
+                    user_rows, audit_rows = user_rows
+                    for row in audit_rows:
+                        audit_writer.write(row)
+                    auditfile.flush()
+                    os.fsync(auditfile.fileno())
+                print(f"{user_email}: {len(user_rows)} Kalender")
+                for row in user_rows:
+                    writer.write(row)
+                count += len(user_rows)
+                # the rows must be on disk before the user counts as done
+                outfile.flush()
+                os.fsync(outfile.fileno())
+                checkpoint.write(user_email + "\n")
+                checkpoint.flush()
+
+        # 5. Audit the calendars no user owns, e.g. holidays or calendars of other domains,
+        # without their ACL, which only owners may read
+        if AUDIT:
+            by_user = {}
+            for cal_id, user_email in unowned.items():
+                by_user.setdefault(user_email, []).append(cal_id)
+            print("Audit von", len(unowned), "Kalendern ohne Eigentümer in der Domain")
+            for audit_rows in pool.map(lambda item: audit_unowned(*item), by_user.items()):
+                for row in audit_rows:
+                    audit_writer.write(row)
+    print("Ausgabedatei geschrieben, ", count, "Einträge")
+    if failed:
+        print("Kalender nicht gelesen für", len(failed), "Benutzer:", ", ".join(failed))
+        print("Der nächste Lauf versucht sie erneut")
+    else:
+        os.remove(CHECKPOINT_FILE)
 
 
 if __name__ == '__main__':
@@ -1,14 +1,34 @@
+import asyncio
+import hashlib
 import os
-import io
+import re
 import sys
+import json
+import shutil
+import multiprocessing
+import threading
+from collections import defaultdict
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 import google.auth.transport.requests
 from google.oauth2.credentials import Credentials
+import google_auth_httplib2
 import google_auth_oauthlib.flow
 import googleapiclient.discovery
+import httplib2
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaIoBaseDownload
+from googleapiclient.http import BatchHttpRequest
+
+from manifest import Manifest
+from metrics import Metrics, Profiler, Progress
+from objectstore import ObjectStore, md5File
+from packs import PackWriter, packName
+from ratelimit import TokenBucket
+from retry import Executor
+from rules import Rules
+from snapshots import createSnapshot, pruneSnapshots, setLatest
 
 SCOPES = [
     "https://www.googleapis.com/auth/drive",
@@ -18,6 +38,95 @@ SCOPES = [
     "https://www.googleapis.com/auth/drive.metadata",
 ]
 
+# --- Configuration ---
+# Apply only the changes since the last run (Drive Changes API) for drives that
+# have a saved start page token. Drives without a token get a full walk.
+INCREMENTAL = True
+# SQLite manifest of the backup tree with the saved page tokens, see manifest.py
+MANIFEST_FILE = "./bkup/.manifest.sqlite"
+# "mirror" writes every file into the backup tree, "cas" stores every content once in
+# OBJECTS_DIR, keyed by its md5 checksum, and hardlinks it into the backup tree, "pack"
+# appends every file zstd compressed to large pack files in PACK_DIR instead of a tree
+# (needs zstandard), every pack has an index next to it, restore with packs.py
+STORE_MODE = "mirror"
+OBJECTS_DIR = "./bkup/.objects"
+PACK_DIR = "./bkup/packs"
+PACK_LEVEL = 3
+PACK_SIZE = 1024 ** 3
+# Back up into a new dated snapshot directory per day below SNAPSHOT_DIR instead of
+# overwriting ./bkup in place. Unchanged files are hardlinked to the previous snapshot.
+SNAPSHOTS = False
+SNAPSHOT_DIR = "./bkup/snapshots"
+# Snapshots kept: the newest of each of the last 7 days, 4 weeks and 12 months
+KEEP_DAILY = 7
+KEEP_WEEKLY = 4
+KEEP_MONTHLY = 12
+# Number of processes backing up drives and subtrees of drives in parallel, 1 for none
+PROCESSES = 1
+# Walk and download full backups with the asyncio client in asyncdrive.py (needs aiohttp):
+# every folder is listed by its own task, ASYNC_WORKERS tasks download over at most
+# ASYNC_CONNECTIONS keep-alive connections with at most ASYNC_IN_FLIGHT requests outstanding
+ASYNC_TRANSPORT = False
+ASYNC_CONNECTIONS = 8
+ASYNC_IN_FLIGHT = 64
+ASYNC_WORKERS = 16
+# Selective backup, see rules.py. Paths start with the drive name like below ./bkup, folders
+# end with "/". Globs like "MyDrive/Videos/", "**/node_modules/" or "**/*.iso", or "re:<regex>".
+# With INCLUDE_PATHS only the matching files and folders are backed up.
+# Excluded folders, and with INCLUDE_PATHS globs folders outside of them, are not listed at all.
+# A run with changed rules walks all drives, so that they apply to unchanged files as well.
+INCLUDE_PATHS = []
+EXCLUDE_PATHS = []
+# Mime types not backed up, e.g. "video/*" or "application/vnd.google-apps.form"
+EXCLUDE_MIME_TYPES = []
+# Files larger than this are not backed up, in bytes, None for no limit
+MAX_FILE_SIZE = None
+# Back up only files modified after this date, e.g. "2024-01-01", None for all
+MODIFIED_SINCE = None
+# Back up the targets of shortcuts at the path of the shortcut
+FOLLOW_SHORTCUTS = True
+# Metadata of a file that the backup needs, requested in every listing
+FILE_FIELDS = "id,name,mimeType,size,modifiedTime,md5Checksum,version,shortcutDetails,parents"
+# Largest page size files().list allows
+PAGE_SIZE = 1000
+# List a whole drive with one paginated query and build the folder tree in memory,
+# instead of one query per folder. Not with INCLUDE_PATHS or EXCLUDE_PATHS, the folders they
+# leave out are not listed then
+FLAT_LISTING = True
+# Sub-requests per batch request, Drive allows at most 100
+BATCH_SIZE = 100
+# How often failed sub-requests of a batch are retried
+BATCH_RETRIES = 5
+# How often a request failing with a rate limit (403/429), server (5xx) or network error is retried
+MAX_RETRIES = 8
+# Number of threads downloading and exporting files in parallel
+WORKERS = 8
+# Requests per second of the download workers, Drive allows 12000 queries per minute and user;
+# with PROCESSES > 1 for all processes together
+MAX_QPS = 200
+MAX_BURST = 50
+# Bytes per download request, downloads are streamed to disk in chunks of this size
+CHUNK_SIZE = 16 * 1024 * 1024
+# The formats Google Docs files are exported to, as file extensions from exportTypesFor.
+# Mime types not listed are exported to the first format in exportTypesFor.
+# Note that Drive exports only the first sheet of a spreadsheet to .csv or .tsv.
+EXPORT_FORMATS = {
+    "application/vnd.google-apps.document": [".docx"],
+    "application/vnd.google-apps.spreadsheet": [".xlsx"],
+}
+# Print every downloaded, exported, linked, moved and removed file
+VERBOSE = False
+# Show a progress line on the terminal
+PROGRESS = True
+# Machine-readable report of the run, with counts, API latencies and queue depths
+REPORT_FILE = "./bkup/.report.json"
+# The same in the Prometheus text format, e.g. for the textfile collector of node_exporter
+PROMETHEUS_FILE = None
+# Profile the run, "cprofile" (the walk in the main thread) or "tracemalloc" (memory of all threads)
+PROFILE = None
+PROFILE_FILE = "./bkup/.profile"
+# --- End Configuration ---
+
 exportTypesFor = {
     "application/vnd.google-apps.document": [
         ("application/vnd.openxmlformats-officedocument.wordprocessingml.document", ".docx"),
@@ -57,13 +166,29 @@ exportTypesFor = {
 }
 
 
+def exportTypes(mimetype):
+    """The (export mime type, file extension) pairs a Google Docs file of mimetype is exported to."""
+    types = exportTypesFor[mimetype]
+    exts = EXPORT_FORMATS.get(mimetype)
+    if not exts:
+        return types[:1]
+    res = [t for t in types if t[1] in exts]
+    if len(res) != len(exts):
+        raise ValueError(f"unknown export format in {exts} for {mimetype}")
+    return res
+
+
 class GDrivePerms:
-    def __init__(self):
-        creds = None
+    def __init__(self, runStamp=None, creds=None, rootUrl=None):
+        """runStamp is the start time of the run, when this is a worker process of backupParallel.
+
+        creds and rootUrl (e.g. http://127.0.0.1:8080/) are given to run against another server than
+        Google's, like the fake server of bench/fakeserver.py.
+        """
         # The file token.json stores the user's access and refresh tokens, and is
         # created automatically when the authorization flow completes for the first
         # time.
-        if os.path.exists('token.json'):
+        if creds is None and os.path.exists('token.json'):
             creds = Credentials.from_authorized_user_file('token.json', SCOPES)
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
@@ -77,25 +202,164 @@ class GDrivePerms:
             with open('token.json', 'w') as token:
                 token.write(creds.to_json())
 
+        self.rootUrl = rootUrl
+        self.clientOptions = {"api_endpoint": rootUrl + "drive/v3/"} if rootUrl else None
         try:
             self.service = googleapiclient.discovery.build(
-                'drive', 'v3', credentials=creds)
+                'drive', 'v3', credentials=creds, client_options=self.clientOptions)
         except HttpError as error:
             print(f'An error occurred: {error}')
+        self.creds = creds
+        self.batchUri = (rootUrl or "https://www.googleapis.com/") + "batch/drive/v3"
+        self.apiUrl = (rootUrl or "https://www.googleapis.com/") + "drive/v3/"
+
+        # httplib2 is not thread-safe, so every download worker gets its own service object
+        self.local = threading.local()
+        self.pool = ThreadPoolExecutor(max_workers=WORKERS)
+        # bounds the number of queued downloads, so that the walk does not run far ahead of the workers
+        self.slots = threading.BoundedSemaphore(WORKERS * 4)
+        self.pending = []
+        self.lock = threading.Lock()
+        # collects the queued downloads instead of submitting them to the pool, see asyncdrive
+        self.jobs = None
+
+        os.makedirs("./bkup", exist_ok=True)
+        # the backup tree, ./bkup/ or the snapshot of this run, see startSnapshot
+        self.root = "./bkup/"
+        # worker processes share the manifest and must not hold its write lock for long
+        self.manifest = Manifest(MANIFEST_FILE, runStamp, commitEvery=1 if runStamp else 1000)
+        if SNAPSHOTS and STORE_MODE == "pack":
+            raise ValueError("snapshots need a backup tree, not packs")
+        self.manifest.setTree(SNAPSHOT_DIR if SNAPSHOTS else PACK_DIR if STORE_MODE == "pack" else self.root)
+        if runStamp is None:
+            # worker processes run with the settings of the main process
+            self.manifest.setSettings(json.dumps(self.settings(), sort_keys=True))
+        self.store = ObjectStore(OBJECTS_DIR) if STORE_MODE == "cas" else None
+        self.packs = PackWriter(PACK_DIR, packName(self.manifest.runStamp), PACK_LEVEL, PACK_SIZE) \
+            if STORE_MODE == "pack" else None
+        # which files are backed up, also used in the q of every listing
+        self.rules = Rules(INCLUDE_PATHS, EXCLUDE_PATHS, EXCLUDE_MIME_TYPES, MAX_FILE_SIZE, MODIFIED_SINCE,
+                           FOLLOW_SHORTCUTS)
+        # md5 -> (key, file, fpath) of the files waiting for the download of the same content
+        self.fetching = {}
+        # paths of the files queued for download or export by this run, see holdsOldCopy
+        self.queued = set()
+        # manifest key of the drive being backed up, its driveId or "MyDrive"
+        self.driveKey = None
+        # (shortcut, fpath) whose targets are fetched together by resolveShortcuts
+        self.shortcuts = []
+        # folder id -> folder metadata fetched by prefetchDirs
+        self.dirInfo = {}
+        # counts of skipped, downloaded, exported, failed, ... files and downloaded bytes, API latencies
+        self.metrics = Metrics()
+        # (fpath, error) of the files whose backup failed
+        self.errors = []
+        # keys of the drives with a folder that could not be listed, see walkFailed
+        self.incomplete = set()
+        # with PROCESSES > 1 the main process plans while the workers back up, each process gets
+        # an equal share of MAX_QPS and MAX_BURST, so that all together stay within them
+        shares = PROCESSES + 1 if PROCESSES > 1 else 1
+        # all API requests go through the executor, which retries them and lowers the concurrency
+        # when Drive throttles; one slot more than WORKERS for the walk
+        self.executor = Executor(WORKERS + 1, TokenBucket(MAX_QPS / shares, max(1, MAX_BURST / shares)),
+                                 MAX_RETRIES, self.count, self.observe)
+
+    def settings(self):
+        """The settings that decide what is backed up of an unchanged file, see Manifest.setSettings."""
+        return {"exportFormats": EXPORT_FORMATS, "include": INCLUDE_PATHS, "exclude": EXCLUDE_PATHS,
+                "excludeMimeTypes": EXCLUDE_MIME_TYPES, "maxSize": MAX_FILE_SIZE, "modifiedSince": MODIFIED_SINCE,
+                "shortcuts": FOLLOW_SHORTCUTS}
+
+    def execute(self, request):
+        return self.executor.execute(request)
+
+    def workerService(self):
+        service = getattr(self.local, "service", None)
+        if service is None:
+            http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+            service = googleapiclient.discovery.build('drive', 'v3', http=http, client_options=self.clientOptions)
+            self.local.service = service
+        return service
+
+    def submit(self, fn, *args):
+        self.slots.acquire()
+        self.metrics.adjust("downloads queued", 1)
+        future = self.pool.submit(fn, *args)
+        future.add_done_callback(self.submitted)
+        with self.lock:
+            self.pending.append(future)
+
+    def submitted(self, future):
+        self.slots.release()
+        self.metrics.adjust("downloads queued", -1)
+
+    def waitDownloads(self):
+        """Waits until all queued downloads and exports are done."""
+        while True:
+            with self.lock:
+                pending = self.pending
+                self.pending = []
+            if not pending:
+                return
+            for future in pending:
+                future.result()
+
+    def close(self):
+        self.waitDownloads()
+        self.pool.shutdown()
+        if self.packs is not None:
+            self.packs.close()
+        self.manifest.close()
+
+    def makeDir(self, path):
+        """Creates the folder ./bkup/<path>, packs have no folders."""
+        if self.packs is None:
+            os.makedirs(self.root + path, exist_ok=True)
+
+    def startSnapshot(self):
+        """Makes today's snapshot the backup tree of this run, see snapshots.createSnapshot."""
+        name = datetime.now().date().isoformat()
+        self.root = createSnapshot(SNAPSHOT_DIR, name) + "/"
+        return name
+
+    def fail(self, fileId, fpath, error=None):
+        """Remembers a file whose backup failed, so that the next incremental run retries it."""
+        self.manifest.setFailed(fileId, self.driveKey, fpath)
+        self.count("failed")
+        with self.lock:
+            self.errors.append((fpath, str(error)))
+
+    def walkFailed(self, fpath, error):
+        """Remembers a folder that could not be listed, so that the next run walks its drive completely again."""
+        print("ErrorList", fpath, error)
+        self.count("failed folders")
+        with self.lock:
+            self.incomplete.add(self.driveKey)
+            self.errors.append((fpath, str(error)))
+
+    def count(self, name, n=1):
+        self.metrics.count(name, n)
+
+    def observe(self, endpoint, seconds):
+        self.metrics.observe(endpoint, seconds)
+
+    def log(self, *args):
+        if VERBOSE:
+            print(*args)
 
     def listDrives(self):
         nextPageTokenD = None
         res = []
         while True:
-            results = self.service.drives().list(
+            results = self.execute(self.service.drives().list(
                 pageToken=nextPageTokenD,
-                pageSize=100).execute()
-            nextPageToken = results.get("nextPageToken")
+                pageSize=100))
+            nextPageTokenD = results.get("nextPageToken")
             items = results.get('drives', [])
             if not items:
                 return res
             res.extend(items)
-            if nextPageToken is None:
+            if nextPageTokenD is None:
                 break
         res.sort(key=lambda x: x.get("name"))
         return res
@@ -103,21 +367,24 @@ class GDrivePerms:
     def listRootLevelFiles(self, driveId):
         nextPageToken = None
         res = []
+        if driveId is None:
+            root = self.execute(self.service.files().get(fileId="root", fields="owners"))
+            self.myDriveOwner = root["owners"][0]["emailAddress"]
         while True:
             if driveId is None:
-                root = self.service.files().get(fileId="root", fields="*").execute()
-                self.myDriveOwner = root["owners"][0]["emailAddress"]
-                results = self.service.files().list(
+                results = self.execute(self.service.files().list(
                     pageToken=nextPageToken,
-                    q="'root' in parents",
-                    pageSize=100).execute()
+                    q=self.rules.query("'root' in parents"),
+                    fields=f"nextPageToken,files({FILE_FIELDS})",
+                    pageSize=PAGE_SIZE))
             else:
-                results = self.service.files().list(
+                results = self.execute(self.service.files().list(
                     driveId=driveId,
                     includeItemsFromAllDrives=True, corpora="drive", supportsAllDrives=True, spaces="drive",
                     pageToken=nextPageToken,
-                    q=f"'{driveId}' in parents",
-                    pageSize=100).execute()
+                    q=self.rules.query(f"'{driveId}' in parents"),
+                    fields=f"nextPageToken,files({FILE_FIELDS})",
+                    pageSize=PAGE_SIZE))
             nextPageToken = results.get("nextPageToken")
             items = results.get('files', [])
             if items:
@@ -131,13 +398,14 @@ class GDrivePerms:
         nextPageToken = None
         res = []
         while True:
-            results = self.service.files().list(
+            results = self.execute(self.service.files().list(
                 pageToken=nextPageToken,
-                q=f"'{fileId}' in parents",
-                pageSize=100,
+                q=self.rules.query(f"'{fileId}' in parents"),
+                fields=f"nextPageToken,files({FILE_FIELDS})",
+                pageSize=PAGE_SIZE,
                 includeItemsFromAllDrives=True,
                 supportsAllDrives=True,
-            ).execute()
+            ))
             nextPageToken = results.get("nextPageToken")
             items = results.get('files', [])
             if items:
@@ -147,59 +415,218 @@ class GDrivePerms:
         res.sort(key=lambda x: x.get("name"))
         return res
 
+    def listDriveFlat(self, driveId):
+        """Lists all files of MyDrive (driveId None) or a shared drive with a single paginated query.
+
+        Returns the root level files and a dict folder id -> files in that folder, both sorted by name.
+        """
+        if driveId is None:
+            rootId = self.execute(self.service.files().get(fileId="root", fields="id"))["id"]
+        else:
+            rootId = driveId
+        children = defaultdict(list)
+        nextPageToken = None
+        while True:
+            if driveId is None:
+                # also returns files shared with me, they have no parent below root and are dropped
+                results = self.execute(self.service.files().list(
+                    corpora="user",
+                    q=self.rules.query(),
+                    pageToken=nextPageToken,
+                    fields=f"nextPageToken,files({FILE_FIELDS})",
+                    pageSize=PAGE_SIZE))
+            else:
+                results = self.execute(self.service.files().list(
+                    driveId=driveId,
+                    includeItemsFromAllDrives=True, corpora="drive", supportsAllDrives=True, spaces="drive",
+                    q=self.rules.query(),
+                    pageToken=nextPageToken,
+                    fields=f"nextPageToken,files({FILE_FIELDS})",
+                    pageSize=PAGE_SIZE))
+            for file in results.get('files', []):
+                for parentId in file.get("parents", []):
+                    children[parentId].append(file)
+            nextPageToken = results.get("nextPageToken")
+            if nextPageToken is None:
+                break
+        for files in children.values():
+            files.sort(key=lambda x: x.get("name"))
+        return children.get(rootId, []), children
+
+    def getFilesBatched(self, fileIds, fields):
+        """Fetches the metadata of many files with batch requests, returns a dict id -> metadata.
+
+        Sub-requests that failed with a rate limit or server error are retried, files that
+        could not be fetched are missing from the result.
+        """
+        requests = {fileId: lambda fileId=fileId: self.service.files().get(
+                        fileId=fileId, fields=fields, supportsAllDrives=True)
+                    for fileId in fileIds}
+        res, errors = self.executor.executeBatch(
+            lambda callback: BatchHttpRequest(callback=callback, batch_uri=self.batchUri),
+            requests, BATCH_SIZE, BATCH_RETRIES)
+        for fileId, error in errors.items():
+            print("ErrorBatch", fileId, error)
+        return res
+
+    def resolveShortcuts(self):
+        """Fetches the targets of the queued shortcuts in batches and backs them up at the shortcut's path."""
+        shortcuts = self.shortcuts
+        self.shortcuts = []
+        targets = self.getFilesBatched([file["shortcutDetails"]["targetId"] for file, _ in shortcuts],
+                                       FILE_FIELDS + ",trashed")
+        for file, fpath in shortcuts:
+            target = targets.get(file["shortcutDetails"]["targetId"])
+            if target is None:
+                print("ErrorSC", fpath)
+                self.fail(file["id"], fpath, "shortcut target not found")
+                continue
+            if target.get("trashed") or target["mimeType"] == "application/vnd.google-apps.folder":
+                continue
+            # recorded under the shortcut's id, the target may be backed up at its own path as well
+            self.handleFile(target, fpath, file["id"])
+
     def normalize(self, name):
         return name.replace("/", "_")
 
-    def listFiles(self, files, indent, path):
-        os.makedirs("./bkup/" + path, exist_ok=True)
+    def listFiles(self, files, indent, path, children=None):
+        """Backs up files into ./bkup/<path>, recursing into folders.
+
+        The contents of a folder are taken from children (see listDriveFlat) if given, else listed.
+        """
+        self.makeDir(path)
         for file in files:
+            fpath = path
             try:
                 isDir = file['mimeType'] == "application/vnd.google-apps.folder"
                 fpath = path + self.normalize(file['name'])
                 if isDir:
                     fpath += "/"
                 if isDir:
-                    subFiles = self.listFilesInDir(file["id"], fpath)
-                    self.listFiles(subFiles, indent + 3, fpath)
+                    if not self.rules.walkDir(fpath):
+                        self.log("Exclude", fpath)
+                        continue
+                    self.manifest.record(file["id"], self.driveKey, fpath, file, backedUp=False)
+                    if children is None:
+                        subFiles = self.listFilesInDir(file["id"], fpath)
+                    else:
+                        subFiles = children.get(file["id"], [])
+                    self.listFiles(subFiles, indent + 3, fpath, children)
                 else:
                     self.handleFile(file, fpath)
             except Exception as e:
-                print("Error", e)
+                self.walkFailed(fpath, e)
+
+    def handleFile(self, file, fpath, key=None):
+        """Backs up a single file, returns its path below ./bkup or None on error or for shortcuts.
 
-    def handleFile(self, file, fpath):
+        key is the id the file is recorded under in the manifest, by default its own id.
+        """
+        key = key or file["id"]
+        if not self.rules.keep(file, fpath):
+            self.count("excluded")
+            return None
         mt = file["mimeType"]
+        if mt == "application/vnd.google-apps.shortcut":
+            # the target is fetched and backed up later in a batch, see resolveShortcuts
+            self.shortcuts.append((file, fpath))
+            return None
         if mt.startswith("application/vnd.google-apps."):
             try:
-                self.exportG(file, fpath)
+                return self.exportG(file, fpath, key)
             except Exception as e:
                 print("ErrorEG", fpath, e)
+                self.fail(key, fpath, e)
         else:
             try:
-                self.bkupFile(file, fpath)
+                return self.bkupFile(file, fpath, key)
             except Exception as e:
                 print("ErrorRF", fpath, e)
+                self.fail(key, fpath, e)
+        return None
 
-    def bkupFile(self, file, fpath):
-        file_id = file["id"]
-        file1Info = self.service.files().get(fileId=file_id,
-                                             fields="size, modifiedTime",
-                                             supportsAllDrives=True,
-                                             ).execute()
-        file2Path = "./bkup/" + fpath
-        if self.probablySame(file1Info, file2Path, False):
-            return
-        mtime = file1Info["mtime"]
-        request = self.service.files().get_media(fileId=file_id)
-        fileIO = io.BytesIO()
-        downloader = MediaIoBaseDownload(fileIO, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            print(f"Download {fpath} {int(status.progress() * 100)}.")
-        content = fileIO.getvalue()
-        with open(file2Path, "wb") as file2:
-            file2.write(content)
-        os.utime(file2Path, (mtime, mtime))
+    def bkupFile(self, file, fpath, key):
+        """Queues the download of a file unless ./bkup already has it, decided from the listed metadata."""
+        if self.isBackedUp(key, file, fpath, ""):
+            return fpath
+        md5 = file.get("md5Checksum")
+        if self.store is not None and md5 is not None:
+            with self.lock:
+                if md5 in self.fetching:
+                    # the same content is being downloaded already, link it when done
+                    self.fetching[md5].append((key, file, fpath))
+                    self.queued.add(fpath)
+                    return fpath
+                stored = self.store.has(md5)
+                if not stored:
+                    self.fetching[md5] = []
+            if stored:
+                self.log("Link", fpath)
+                self.linkFromStore(key, file, fpath, "", md5)
+                return fpath
+        self.queueDownload(key, file, None, fpath)
+        return fpath
+
+    def linkFromStore(self, key, file, fpath, exportMime, md5):
+        self.store.link(md5, self.root + fpath)
+        self.manifest.record(key, self.driveKey, fpath, file, exportMime)
+        self.count("linked")
+
+    def isBackedUp(self, key, file, relPath, exportMime):
+        """Tells from the manifest if ./bkup/<relPath> holds the current version of file.
+
+        A file that was moved or renamed since is moved locally. Trees backed up before the
+        manifest existed fall back to comparing size and mtime, in pack mode only the packed
+        files recorded in the manifest count.
+        """
+        file["mtime"] = int(datetime.fromisoformat(file["modifiedTime"]).timestamp())
+        row = self.manifest.lookup(key, exportMime)
+        if row is None:
+            if self.packs is None and self.probablySame(file, self.root + relPath, exportMime != ""):
+                self.manifest.record(key, self.driveKey, relPath, file, exportMime, backedUp=False)
+                self.count("skipped")
+                return True
+            return False
+        if self.packs is not None and row["pack"] is None:
+            return False
+        # the version changes with every change of the file, also metadata only changes
+        sameRemote = (row["version"] is not None and row["version"] == file.get("version")) or \
+                     (row["modifiedTime"] == file["modifiedTime"] and row["md5Checksum"] == file.get("md5Checksum"))
+        if row["path"] == relPath:
+            # the local copy may be gone, e.g. removed by hand
+            if sameRemote and (self.packs is not None or os.path.exists(self.root + relPath)):
+                self.manifest.touch(key, exportMime, file)
+                self.count("skipped")
+                return True
+            return False
+        # a row already seen by this run belongs to another copy of a file with several parents
+        if self.packs is not None:
+            # the content stays where it is in its pack
+            if sameRemote and row["seen"] < self.manifest.runStamp:
+                self.log("Move", row["path"], relPath)
+                self.manifest.record(key, self.driveKey, relPath, file, exportMime, backedUp=False)
+                self.count("moved")
+                return True
+            return False
+        oldPath = self.root + row["path"]
+        if row["seen"] < self.manifest.runStamp and self.holdsOldCopy(row):
+            if sameRemote:
+                self.log("Move", row["path"], relPath)
+                os.makedirs(os.path.dirname(self.root + relPath), exist_ok=True)
+                os.replace(oldPath, self.root + relPath)
+                self.manifest.record(key, self.driveKey, relPath, file, exportMime, backedUp=False)
+                self.count("moved")
+                return True
+            os.remove(oldPath)
+        return False
+
+    def holdsOldCopy(self, row):
+        """Tells if the local file at the path of the manifest row is still the copy recorded there,
+        and not another file that this run backs up to the same path."""
+        with self.lock:
+            if row["path"] in self.queued:
+                return False
+        return os.path.exists(self.root + row["path"]) and not self.manifest.claimed(row)
 
     def probablySame(self, file1Info, file2Path, exported):
         file1Mtime = datetime.fromisoformat(file1Info["modifiedTime"])
@@ -209,79 +636,614 @@ class GDrivePerms:
         try:
             file2Info = os.stat(file2Path)
         except:
-            # print("missing", file2Path)
-            # print("file1", file1Info)
             return False
         if (not exported and int(file1Info["size"]) != file2Info.st_size) or int(file1Secs) != file2Info.st_mtime:
-            print("notSame", file2Path)
-            print("file1", file1Info)
-            print("file2", file2Info)
             return False
-        print("isSame", file2Path)
         return True
 
-    def exportG(self, file, fpath):
-        file_id = file["id"]
-        mimetype = file["mimeType"]
-        exportType, fileExt = exportTypesFor[mimetype][0]
-        file1Info = self.service.files().get(fileId=file_id,
-                                             fields="size, modifiedTime,shortcutDetails",
-                                             supportsAllDrives=True,
-                                             ).execute()
-        if mimetype == "application/vnd.google-apps.shortcut":
-            fileSC = self.service.files().get(fileId=file1Info["shortcutDetails"]["targetId"],
-                                              fields="id,name,mimeType,size,modifiedTime,shortcutDetails",
-                                              supportsAllDrives=True,
-                                              ).execute()
-
-            self.handleFile(fileSC, fpath)
+    def exportG(self, file, fpath, key):
+        """Queues the exports of a Google Docs file to the formats of EXPORT_FORMATS that ./bkup does
+        not have yet, returns the path of the first format.
+
+        Every format is a separate job for the download workers, and has its own manifest row,
+        so only the formats not yet exported from the current version are exported.
+        """
+        paths = []
+        for exportType, fileExt in exportTypes(file["mimeType"]):
+            paths.append(fpath + fileExt)
+            if not self.isBackedUp(key, file, fpath + fileExt, exportType):
+                self.queueDownload(key, file, exportType, fpath + fileExt)
+        return paths[0]
+
+    def queueDownload(self, key, file1Info, exportType, fpath):
+        """Queues the download (exportType None) or export of a file to ./bkup/<fpath>."""
+        with self.lock:
+            self.queued.add(fpath)
+        if self.jobs is not None:
+            self.jobs.append((key, file1Info, exportType, fpath))
+        else:
+            self.submit(self.download, key, file1Info, exportType, fpath)
+
+    def download(self, key, file1Info, exportType, fpath):
+        """Runs in a worker thread, downloads (exportType None) or exports a file to ./bkup/<fpath>."""
+        fileId = file1Info["id"]
+        try:
+            service = self.workerService()
+            if exportType is None:
+                request = service.files().get_media(fileId=fileId)
+                # its methodId is that of get, keep the chunks apart from the metadata requests
+                endpoint = "drive.files.get_media"
+            else:
+                request = service.files().export_media(fileId=fileId, mimeType=exportType)
+                endpoint = request.methodId
+            tmpPath, offset = self.startDownload(file1Info, exportType, fpath)
+            try:
+                with open(tmpPath, "ab" if offset else "wb") as file2:
+                    if not offset or offset < int(file1Info["size"]):
+                        done = False
+                        while not done:
+                            done = self.executor.call(lambda: self.downloadChunk(request, file2), endpoint)
+                    file2.flush()
+                    os.fsync(file2.fileno())
+            except BaseException:
+                self.abortDownload(tmpPath, exportType)
+                raise
+            self.finishDownload(key, file1Info, exportType, fpath, tmpPath)
+            self.log(f"{'Download' if exportType is None else 'Export'} {fpath}")
+        except Exception as e:
+            self.downloadFailed(key, file1Info, exportType, fpath, e)
+
+    def downloadChunk(self, request, file2):
+        """Requests the next CHUNK_SIZE bytes of the media request, from the end of file2 on, and appends
+        them to file2. Returns True when the download is complete.
+
+        Only a 206 response starting at the requested offset is appended, a 200 response with the
+        whole content replaces what file2 has. Nothing is written if the request fails, so it can be retried.
+        """
+        offset = file2.seek(0, os.SEEK_END)
+        headers = dict(request.headers, range=f"bytes={offset}-{offset + CHUNK_SIZE - 1}")
+        resp, content = request.http.request(request.uri, method="GET", headers=headers)
+        if resp.status == 416 and offset == 0:
+            # an empty file
+            return True
+        if resp.status >= 300:
+            raise HttpError(resp, content, uri=request.uri)
+        self.count("bytes", len(content))
+        if resp.status == 200:
+            file2.seek(0)
+            file2.truncate()
+            file2.write(content)
+            return True
+        m = re.fullmatch(r"bytes (\d+)-(\d+)/(\d+|\*)", resp.get("content-range", ""))
+        if m is None or int(m.group(1)) != offset:
+            raise ValueError(f"unexpected range {resp.get('content-range')} for offset {offset}")
+        file2.write(content)
+        return m.group(3) != "*" and int(m.group(2)) + 1 >= int(m.group(3))
+
+    def startDownload(self, file1Info, exportType, fpath):
+        """Returns the temp file to download into and the offset to resume at.
+
+        Downloads are streamed into a temp file next to the target and renamed when complete, so that
+        an interrupted download never leaves a truncated file under the target name.
+        Downloads (but not exports) can be resumed with a Range request if the source did not change.
+        """
+        if self.packs is None:
+            tmpPath = self.root + fpath + ".part"
+        else:
+            # named by the path, a file with several parents or shortcuts is downloaded once per path
+            tmpPath = self.packs.tmpPath(hashlib.sha1(fpath.encode()).hexdigest() + ".part")
+        offset = 0
+        if exportType is None:
+            offset = self.partialOffset(tmpPath, file1Info)
+            if offset:
+                self.log(f"Resume {fpath} at {offset}")
+            else:
+                self.writePartInfo(tmpPath, file1Info)
+        return tmpPath, offset
+
+    def abortDownload(self, tmpPath, exportType):
+        if exportType is not None and os.path.exists(tmpPath):
+            os.remove(tmpPath)
+
+    def finishDownload(self, key, file1Info, exportType, fpath, tmpPath):
+        """Moves a complete download from tmpPath to ./bkup/<fpath> and records it in the manifest."""
+        if self.packs is not None:
+            self.finishPacked(key, file1Info, exportType, fpath, tmpPath)
             return
-        file2Path = "./bkup/" + fpath + fileExt
-        if self.probablySame(file1Info, file2Path, True):
+        file2Path = self.root + fpath
+        if self.store is None:
+            os.utime(tmpPath, (file1Info["mtime"], file1Info["mtime"]))
+            os.replace(tmpPath, file2Path)
+        else:
+            md5 = md5File(tmpPath)
+            expected = file1Info.get("md5Checksum")
+            # never store a corrupt download under the checksum of the good content; files without
+            # a checksum from Drive are stored under the checksum of what was downloaded
+            if exportType is None and expected is not None and md5 != expected:
+                os.remove(tmpPath)
+                raise ValueError(f"checksum mismatch {md5} != {expected}")
+            self.store.add(tmpPath, md5, file1Info["mtime"])
+            self.store.link(md5, file2Path)
+        if exportType is None:
+            os.remove(tmpPath + ".json")
+        self.manifest.record(key, self.driveKey, fpath, file1Info, exportType or "")
+        self.count("downloaded" if exportType is None else "exported")
+        for waiter in self.takeWaiters(file1Info, exportType):
+            self.linkFromStore(*waiter, "", md5)
+
+    def finishPacked(self, key, file1Info, exportType, fpath, tmpPath):
+        """Appends a complete download to the packs and records where it is in the manifest."""
+        pack, offset, length = self.packs.add(tmpPath, {
+            "id": key, "exportMime": exportType or "", "drive": self.driveKey, "path": fpath,
+            "modifiedTime": file1Info["modifiedTime"], "md5Checksum": file1Info.get("md5Checksum"),
+            "size": file1Info.get("size")})
+        os.remove(tmpPath)
+        if exportType is None:
+            os.remove(tmpPath + ".json")
+        self.manifest.record(key, self.driveKey, fpath, file1Info, exportType or "")
+        self.manifest.setPacked(key, exportType or "", pack, offset, length)
+        self.count("downloaded" if exportType is None else "exported")
+
+    def downloadFailed(self, key, file1Info, exportType, fpath, e):
+        print("ErrorRF" if exportType is None else "ErrorEG", fpath, e)
+        self.fail(key, fpath, e)
+        for waiterKey, _, waiterPath in self.takeWaiters(file1Info, exportType):
+            self.fail(waiterKey, waiterPath, e)
+
+    def takeWaiters(self, file1Info, exportType):
+        """Returns and forgets the files waiting for this download of the same content."""
+        if self.store is None or exportType is not None:
+            return []
+        with self.lock:
+            return self.fetching.pop(file1Info.get("md5Checksum"), [])
+
+    def partialOffset(self, tmpPath, file1Info):
+        """Returns the size of a partial download that can be resumed, 0 if there is none.
+
+        A partial download is kept together with the modifiedTime and md5Checksum of its source in
+        <tmpPath>.json, and thrown away if the source changed since.
+        """
+        try:
+            with open(tmpPath + ".json", encoding="utf-8") as f:
+                partInfo = json.load(f)
+            offset = os.path.getsize(tmpPath)
+        except (OSError, ValueError):
+            return 0
+        if (partInfo.get("modifiedTime") != file1Info.get("modifiedTime")
+                or partInfo.get("md5Checksum") != file1Info.get("md5Checksum")
+                or offset > int(file1Info.get("size", 0))):
+            return 0
+        return offset
+
+    def writePartInfo(self, tmpPath, file1Info):
+        with open(tmpPath + ".json", "w", encoding="utf-8") as f:
+            json.dump({
+                "modifiedTime": file1Info.get("modifiedTime"),
+                "md5Checksum": file1Info.get("md5Checksum"),
+                "size": file1Info.get("size"),
+            }, f)
+
+    def getStartPageToken(self, driveId):
+        if driveId is None:
+            res = self.execute(self.service.changes().getStartPageToken())
+        else:
+            res = self.execute(self.service.changes().getStartPageToken(
+                driveId=driveId, supportsAllDrives=True))
+        return res["startPageToken"]
+
+    def backupDrive(self, driveId, drvPath):
+        """Backs up MyDrive (driveId None) or a shared drive into ./bkup/<drvPath>.
+
+        If INCREMENTAL is set and a previous run saved a start page token for the drive,
+        only the changes since then are applied, otherwise the whole drive is walked.
+        """
+        key = driveId or "MyDrive"
+        if ASYNC_TRANSPORT and not (INCREMENTAL and self.manifest.getToken(key)):
+            self.driveKey = key
+            # Fetch the token first, so that changes made during the walk are seen by the next run
+            token = self.getStartPageToken(driveId)
+            asyncio.run(self.backupAsync(driveId, drvPath))
+            self.finishDrive(key, True, token)
             return
-        mtime = file1Info["mtime"]
-        request = self.service.files().export_media(fileId=file_id, mimeType=exportType)
-        fileIO = io.BytesIO()
-        downloader = MediaIoBaseDownload(fileIO, request)
-        done = False
-        while done is False:
-            status, done = downloader.next_chunk()
-            print(f"Export {fpath} {int(status.progress() * 100)}.")
-        content = fileIO.getvalue()
-        with open(file2Path, "wb") as file2:
-            file2.write(content)
-        os.utime(file2Path, (mtime, mtime))
+        units, full, token = self.planDrive(driveId, drvPath, 0)
+        for unit in units:
+            token = self.backupUnit(unit) or token
+        self.finishDrive(key, full, token)
+
+    async def backupAsync(self, driveId, drvPath):
+        import asyncdrive
+
+        # shares the token bucket with the requests of the executor
+        async with asyncdrive.AsyncDrive(self.creds, self.apiUrl, ASYNC_CONNECTIONS, ASYNC_IN_FLIGHT,
+                                         MAX_RETRIES, self.count, self.observe,
+                                         bucket=self.executor.bucket) as drive:
+            await asyncdrive.backupDrive(self, drive, driveId, drvPath, FILE_FIELDS, PAGE_SIZE, ASYNC_WORKERS)
+        self.manifest.commit()
+
+    def planDrive(self, driveId, drvPath, parts):
+        """Splits the backup of a drive into work units for backupUnit.
+
+        Returns the units, largest first, if this is a full walk, and the page token to save when
+        all units succeeded (for incremental runs the token is returned by the unit).
+        A full walk is split into about `parts` subtrees of similar size, 0 for a single unit.
+        """
+        key = driveId or "MyDrive"
+        self.driveKey = key
+        token = self.manifest.getToken(key)
+        if INCREMENTAL and token:
+            return [{"key": key, "driveId": driveId, "path": drvPath, "changes": token, "weight": 0}], False, None
+        # Fetch the token first, so that changes made during the walk are seen by the next run
+        token = self.getStartPageToken(driveId)
+        # the flat listing lists all folders, also those the rules leave out
+        if FLAT_LISTING and not self.rules.prunes:
+            files, children = self.listDriveFlat(driveId)
+        else:
+            files, children = self.listRootLevelFiles(driveId), None
+        unit = {"key": key, "driveId": driveId, "path": drvPath, "files": files, "children": children, "weight": 0}
+        if parts == 0:
+            return [unit], True, token
+        units = []
+        if children is None:
+            # subtree sizes are unknown before listing them, split at the top level only
+            direct = [f for f in files if f["mimeType"] != "application/vnd.google-apps.folder"]
+            if direct:
+                units.append(dict(unit, files=direct))
+            units.extend(dict(unit, files=[f], weight=1) for f in files
+                         if f["mimeType"] == "application/vnd.google-apps.folder")
+        else:
+            sizes = {}
+
+            def size(folderId):
+                if folderId not in sizes:
+                    sizes[folderId] = sum(size(f["id"]) if f["mimeType"] == "application/vnd.google-apps.folder"
+                                          else 1 for f in children.get(folderId, []))
+                return sizes[folderId]
+
+            total = sum(size(f["id"]) if f["mimeType"] == "application/vnd.google-apps.folder" else 1
+                        for f in files)
+            self.splitUnits(unit, files, drvPath, max(total // parts, 100), size, units)
+        units.sort(key=lambda u: u["weight"], reverse=True)
+        return units, True, token
+
+    def splitUnits(self, unit, files, path, threshold, size, units):
+        """Adds units for the files in path, folders with more than threshold files are split further."""
+        children = unit["children"]
+        direct = [f for f in files if f["mimeType"] != "application/vnd.google-apps.folder"]
+        if direct:
+            units.append(dict(unit, files=direct, path=path, children={}, weight=len(direct)))
+        for folder in files:
+            if folder["mimeType"] != "application/vnd.google-apps.folder":
+                continue
+            if size(folder["id"]) > threshold:
+                fpath = path + self.normalize(folder["name"]) + "/"
+                self.manifest.record(folder["id"], self.driveKey, fpath, folder, backedUp=False)
+                self.splitUnits(unit, children.get(folder["id"], []), fpath, threshold, size, units)
+                continue
+            # only the part of the folder index below this folder goes with the unit
+            subtree = {}
+            todo = [folder["id"]]
+            while todo:
+                folderId = todo.pop()
+                subtree[folderId] = children.get(folderId, [])
+                todo.extend(f["id"] for f in subtree[folderId]
+                            if f["mimeType"] == "application/vnd.google-apps.folder")
+            units.append(dict(unit, files=[folder], path=path, children=subtree, weight=size(folder["id"])))
+
+    def backupUnit(self, unit):
+        """Backs up a work unit from planDrive, returns the new page token for incremental units."""
+        self.driveKey = unit["key"]
+        token = None
+        if "changes" in unit:
+            token = self.applyChanges(unit["driveId"], unit["path"], unit["changes"])
+        else:
+            self.listFiles(unit["files"], 0 if unit["driveId"] is None else 3, unit["path"], unit["children"])
+        self.resolveShortcuts()
+        self.waitDownloads()
+        self.manifest.commit()
+        return token
+
+    def finishDrive(self, key, full, token):
+        """Saves the page token of a drive whose units all succeeded, forgets the files a full walk did not find.
+
+        A walk that left out files because of the rules does not forget them, they are still backed up.
+        A drive with a folder that could not be listed keeps its old token and files, so that the next
+        run walks it completely again.
+        """
+        if key in self.incomplete:
+            return
+        if full and not self.rules.selective:
+            self.manifest.removeUnseen(key)
+        self.manifest.setToken(key, token)
+        self.manifest.commit()
+
+    def applyChanges(self, driveId, drvPath, pageToken):
+        """Applies the changes since pageToken to ./bkup/<drvPath>, returns the token for the next run."""
+        rootId = driveId or self.execute(self.service.files().get(fileId="root", fields="id"))["id"]
+        self.manifest.record(rootId, self.driveKey, drvPath, {"mimeType": "application/vnd.google-apps.folder"},
+                             backedUp=False)
+        self.dirInfo = {}
+
+        # files that failed last time are retried even if they did not change
+        failed = self.manifest.getFailed(self.driveKey)
+        files = self.getFilesBatched(failed.keys(), FILE_FIELDS + ",trashed")
+        for fileId, fpath in failed.items():
+            file = files.get(fileId)
+            if file is None:
+                print("ErrorRetry", fpath)
+                continue
+            if not file.get("trashed"):
+                self.handleFile(file, fpath, fileId)
+
+        while True:
+            if driveId is None:
+                results = self.execute(self.service.changes().list(
+                    pageToken=pageToken,
+                    fields="nextPageToken,newStartPageToken,"
+                           f"changes(changeType,fileId,removed,file({FILE_FIELDS},trashed))",
+                    pageSize=1000))
+            else:
+                results = self.execute(self.service.changes().list(
+                    driveId=driveId,
+                    includeItemsFromAllDrives=True, supportsAllDrives=True,
+                    pageToken=pageToken,
+                    fields="nextPageToken,newStartPageToken,"
+                           f"changes(changeType,fileId,removed,file({FILE_FIELDS},trashed))",
+                    pageSize=1000))
+            changes = [change for change in results.get("changes", []) if change.get("changeType", "file") == "file"]
+            self.prefetchDirs([change["file"].get("parents", [None])[0] for change in changes
+                               if change.get("file") is not None])
+            for change in changes:
+                try:
+                    self.applyChange(change)
+                except Exception as e:
+                    print("ErrorCh", change.get("fileId"), e)
+            if "newStartPageToken" in results:
+                return results["newStartPageToken"]
+            pageToken = results["nextPageToken"]
+
+    def applyChange(self, change):
+        fileId = change["fileId"]
+        file = change.get("file")
+        if change.get("removed") or file is None or file.get("trashed"):
+            self.removeLocal(fileId)
+            return
+        if file["mimeType"] != "application/vnd.google-apps.folder":
+            self.updateShortcutCopies(file)
+        parentPath = self.resolveDir(file.get("parents", [None])[0])
+        if parentPath is None:
+            # not (or no longer) below the drive root, e.g. a file shared with me
+            self.removeLocal(fileId)
+            return
+        fpath = parentPath + self.normalize(file["name"])
+        if file["mimeType"] == "application/vnd.google-apps.folder":
+            fpath += "/"
+            row = self.manifest.lookup(fileId)
+            if row is not None and row["path"] != fpath:
+                self.log("Move", row["path"], fpath)
+                self.moveLocal(row["path"], fpath)
+            if self.rules.walkDir(fpath):
+                self.makeDir(fpath)
+            self.manifest.record(fileId, self.driveKey, fpath, file, backedUp=False)
+            return
+        # moves and renames are detected by isBackedUp
+        self.makeDir(parentPath)
+        self.handleFile(file, fpath)
+
+    def updateShortcutCopies(self, file):
+        """Backs up a changed file again at the paths of the shortcuts to it, see resolveShortcuts.
+
+        The changes only name the target. Copies in another drive are retried when that drive is
+        backed up next, like failed files.
+        """
+        copies = {}
+        for row in self.manifest.shortcutsTo(file["id"]):
+            # the path of an export has the extension of its format
+            ext = dict(exportTypesFor.get(row["mimeType"], [])).get(row["exportMime"], "") if row["exportMime"] else ""
+            copies[row["id"]] = (row["drive"], row["path"][:len(row["path"]) - len(ext)])
+        for shortcutId, (drive, fpath) in copies.items():
+            if drive == self.driveKey:
+                self.handleFile(file, fpath, shortcutId)
+            else:
+                self.manifest.setFailed(shortcutId, drive, fpath)
+
+    def resolveDir(self, folderId):
+        """Returns the path below ./bkup of a folder, None if it is not inside the drive."""
+        if folderId is None:
+            return None
+        row = self.manifest.lookup(folderId)
+        if row is not None:
+            return row["path"]
+        folder = self.dirInfo.get(folderId)
+        if folder is None:
+            try:
+                folder = self.execute(self.service.files().get(fileId=folderId,
+                                                  fields="id,name,mimeType,parents,trashed",
+                                                  supportsAllDrives=True,
+                                                  ))
+            except HttpError:
+                return None
+        if folder.get("trashed"):
+            return None
+        parentPath = self.resolveDir(folder.get("parents", [None])[0])
+        if parentPath is None:
+            return None
+        fpath = parentPath + self.normalize(folder["name"]) + "/"
+        self.manifest.record(folderId, self.driveKey, fpath, folder, backedUp=False)
+        return fpath
+
+    def prefetchDirs(self, folderIds):
+        """Fetches the unknown folders among folderIds and their ancestors, one batch per tree level."""
+        todo = {folderId for folderId in folderIds
+                if folderId is not None and folderId not in self.dirInfo and self.manifest.lookup(folderId) is None}
+        while todo:
+            folders = self.getFilesBatched(todo, "id,name,mimeType,parents,trashed")
+            self.dirInfo.update(folders)
+            todo = {folder.get("parents", [None])[0] for folder in folders.values()}
+            todo = {folderId for folderId in todo
+                    if folderId is not None and folderId not in self.dirInfo
+                    and self.manifest.lookup(folderId) is None}
+
+    def moveLocal(self, oldPath, newPath):
+        """Moves a folder, everything below it moves with it."""
+        if os.path.exists(self.root + oldPath):
+            os.makedirs(os.path.dirname(self.root + newPath.rstrip("/")), exist_ok=True)
+            os.replace(self.root + oldPath, self.root + newPath)
+        self.manifest.movePrefix(self.driveKey, oldPath, newPath)
+
+    def removeLocal(self, fileId):
+        """Removes the local copies of a file or folder that was trashed or removed."""
+        for row in self.manifest.rows(fileId):
+            self.log("Remove", row["path"])
+            self.count("removed")
+            file2Path = self.root + row["path"]
+            if row["path"].endswith("/"):
+                shutil.rmtree(file2Path, ignore_errors=True)
+                self.manifest.removePrefix(row["drive"], row["path"])
+            elif os.path.exists(file2Path):
+                os.remove(file2Path)
+        self.manifest.remove(fileId)
 
     def about(self):
-        res = self.service.about().get(fields="exportFormats").execute()
+        res = self.execute(self.service.about().get(fields="exportFormats"))
         print(res)
 
 
+# the GDrivePerms of a worker process of backupParallel
+worker = None
+
+
+def initWorker(root, runStamp, creds, rootUrl):
+    global worker
+    worker = GDrivePerms(runStamp, creds, rootUrl)
+    worker.root = root
+
+
+def runUnit(unit):
+    """Runs in a worker process, backs up a unit and returns its token, metrics and errors."""
+    worker.metrics = Metrics()
+    worker.errors = []
+    worker.incomplete = set()
+    ok = True
+    token = None
+    try:
+        token = worker.backupUnit(unit)
+    except Exception as e:
+        print("ErrorUnit", unit["path"], e)
+        worker.errors.append((unit["path"], str(e)))
+        ok = False
+    ok = ok and unit["key"] not in worker.incomplete
+    return {"key": unit["key"], "ok": ok, "token": token, "metrics": worker.metrics, "errors": worker.errors}
+
+
+def backupParallel(gdp, drives):
+    """Backs up the (driveId, drvPath) drives in PROCESSES worker processes.
+
+    gdp lists the drives and splits them into units, which are handed to the workers as soon as
+    a drive is planned. Each worker has its own credentials, Drive service and manifest connection.
+    The metrics and errors of all units are merged into gdp.metrics and gdp.errors.
+    """
+    plans = {}
+    results = []
+    ctx = multiprocessing.get_context("spawn")
+    with ctx.Pool(PROCESSES, initializer=initWorker, initargs=(gdp.root, gdp.manifest.runStamp, gdp.creds, gdp.rootUrl)) as pool:
+        for driveId, drvPath in drives:
+            key = driveId or "MyDrive"
+            try:
+                units, full, token = gdp.planDrive(driveId, drvPath, PROCESSES * 4)
+            except Exception as e:
+                print("ErrorDrive", drvPath, e)
+                gdp.errors.append((drvPath, str(e)))
+                continue
+            # the workers must see the folders recorded by planDrive
+            gdp.manifest.commit()
+            plans[key] = {"ok": True, "full": full, "token": token}
+            for unit in units:
+                results.append(pool.apply_async(runUnit, (unit,)))
+        for result in results:
+            res = result.get()
+            gdp.metrics.merge(res["metrics"])
+            gdp.errors.extend(res["errors"])
+            plan = plans[res["key"]]
+            plan["ok"] = plan["ok"] and res["ok"]
+            plan["token"] = res["token"] or plan["token"]
+    for key, plan in plans.items():
+        # a drive with a failed unit is walked completely again by the next run
+        if plan["ok"]:
+            gdp.finishDrive(key, plan["full"], plan["token"])
+
+
+def printSummary(gdp):
+    report = gdp.metrics.report()
+    print("Summary:", ", ".join(f"{name} {n}" for name, n in report["counters"].items()))
+    print(f"Time: {report['elapsed']:.0f}s")
+    for endpoint, info in report["endpoints"].items():
+        print(f"  {endpoint}: {info['calls']} calls, mean {info['mean'] * 1000:.0f} ms, p95 <= {info['p95']} s")
+    for fpath, error in gdp.errors:
+        print("Failed", fpath, error)
+
+
 def main():
     namePart = (sys.argv[1] if len(sys.argv) > 1 else "").lower()
     gdp = GDrivePerms()
     # gdp.about()
-    print("MyDrive")
-    os.makedirs("./bkup", exist_ok=True)
-    files = gdp.listRootLevelFiles(None)
-    gdp.listFiles(files, 0, "MyDrive/")
+    run(gdp, namePart)
+
 
+def run(gdp, namePart=""):
+    """Backs up My Drive and the shared drives whose name contains namePart and that the rules
+    do not exclude, then writes the report."""
+    profiler = Profiler(PROFILE, PROFILE_FILE)
+    with profiler, Progress(gdp.metrics) if PROGRESS else nullcontext():
+        backup(gdp, namePart)
     print()
+    printSummary(gdp)
+    print(profiler.summary(), end="")
+    if REPORT_FILE:
+        gdp.metrics.writeJson(REPORT_FILE, errors=gdp.errors)
+    if PROMETHEUS_FILE:
+        gdp.metrics.writePrometheus(PROMETHEUS_FILE)
     print()
-    print('Geteilte Ablagen:')
-    drives = gdp.listDrives()
-    for drive in drives:
-        drvName = drive["name"]
-        if namePart != "" and drvName.lower().find(namePart) == -1:
-            continue
+
+
+def backup(gdp, namePart):
+    if SNAPSHOTS:
+        snapshot = gdp.startSnapshot()
+        print("Snapshot", snapshot)
+    if PROCESSES > 1:
+        drives = [(None, "MyDrive/")] if gdp.rules.walkDir("MyDrive/") else []
+        for drive in gdp.listDrives():
+            drvName = drive["name"]
+            if (namePart != "" and drvName.lower().find(namePart) == -1) or not gdp.rules.walkDir(drvName + "/"):
+                continue
+            gdp.makeDir(drvName)
+            drives.append((drive["id"], drvName + "/"))
+        backupParallel(gdp, drives)
+    else:
+        if gdp.rules.walkDir("MyDrive/"):
+            print("MyDrive")
+            gdp.backupDrive(None, "MyDrive/")
+
         print()
-        driveId = drive["id"]
-        print(drvName)
         print()
-        files = gdp.listRootLevelFiles(driveId)
-        os.makedirs("./bkup/" + drvName, exist_ok=True)
-        gdp.listFiles(files, 3, drvName + "/")
-    print()
+        print('Geteilte Ablagen:')
+        drives = gdp.listDrives()
+        for drive in drives:
+            drvName = drive["name"]
+            if (namePart != "" and drvName.lower().find(namePart) == -1) or not gdp.rules.walkDir(drvName + "/"):
+                continue
+            print()
+            driveId = drive["id"]
+            print(drvName)
+            print()
+            gdp.makeDir(drvName)
+            gdp.backupDrive(driveId, drvName + "/")
+    gdp.close()
+    if SNAPSHOTS:
+        setLatest(SNAPSHOT_DIR, snapshot)
+        for name in pruneSnapshots(SNAPSHOT_DIR, KEEP_DAILY, KEEP_WEEKLY, KEEP_MONTHLY):
+            print("Removed snapshot", name)
+    if STORE_MODE == "cas":
+        print("Removed", gdp.store.prune(), "unused objects")
 
 
 if __name__ == '__main__':
@@ -0,0 +1,249 @@
+import sqlite3
+import sys
+import threading
+from datetime import datetime, timedelta, timezone
+
+
+class Manifest:
+    """SQLite manifest of the backup tree, keyed by Drive file id.
+
+    For every backed up file (or folder) it stores the remote metadata the backup was made from
+    and the path below ./bkup, so that the skip decision is an indexed lookup instead of a stat,
+    and moved or renamed files can be moved locally. It also keeps the start page token of every
+    drive and the files whose backup failed. Exported Google Docs have one row per export mime
+    type, all other files use the export mime type "". With STORE_MODE "pack" it also tells where in
+    the pack files the content of every file is, see packs.PackWriter.
+    """
+
+    def __init__(self, dbPath, runStamp=None, commitEvery=1000):
+        """runStamp is the start time of the run, by default now.
+
+        Writes are committed every commitEvery writes. Processes sharing the manifest use 1,
+        as SQLite allows only one writer at a time.
+        """
+        self.db = sqlite3.connect(dbPath, timeout=60, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT NOT NULL,
+                exportMime TEXT NOT NULL DEFAULT '',
+                drive TEXT NOT NULL,
+                path TEXT NOT NULL,
+                mimeType TEXT,
+                modifiedTime TEXT,
+                md5Checksum TEXT,
+                size INTEGER,
+                version TEXT,
+                targetId TEXT,
+                pack TEXT,
+                packOffset INTEGER,
+                packLength INTEGER,
+                backedUp TEXT NOT NULL,
+                seen TEXT NOT NULL,
+                PRIMARY KEY (id, exportMime)
+            );
+            CREATE INDEX IF NOT EXISTS filesPath ON files (drive, path);
+            CREATE INDEX IF NOT EXISTS filesBackedUp ON files (backedUp);
+            CREATE TABLE IF NOT EXISTS drives (
+                drive TEXT PRIMARY KEY,
+                token TEXT
+            );
+            CREATE TABLE IF NOT EXISTS meta (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS failed (
+                id TEXT NOT NULL,
+                drive TEXT NOT NULL,
+                path TEXT NOT NULL,
+                PRIMARY KEY (id, drive)
+            );
+        """)
+        # manifests written before these columns existed
+        columns = [row["name"] for row in self.db.execute("PRAGMA table_info(files)")]
+        for column, columnType in (("version", "TEXT"), ("targetId", "TEXT"), ("pack", "TEXT"),
+                                   ("packOffset", "INTEGER"), ("packLength", "INTEGER")):
+            if column not in columns:
+                self.db.execute(f"ALTER TABLE files ADD COLUMN {column} {columnType}")
+        if "targetId" not in columns:
+            # the next run walks all drives and records the targets of the shortcuts
+            self.db.execute("DELETE FROM drives")
+            self.db.commit()
+        self.db.execute("CREATE INDEX IF NOT EXISTS filesTarget ON files (targetId)")
+        self.lock = threading.Lock()
+        # the time this run started, stored in "seen" for every file found by the run
+        self.runStamp = runStamp or now()
+        self.commitEvery = commitEvery
+        self.writes = 0
+
+    def write(self, sql, args=()):
+        with self.lock:
+            self.db.execute(sql, args)
+            self.writes += 1
+            if self.writes >= self.commitEvery:
+                self.db.commit()
+                self.writes = 0
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+            self.writes = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def setTree(self, tree):
+        """Tells which backup tree the manifest describes.
+
+        If it described another tree before, e.g. after switching to snapshots, the files, tokens
+        and failures recorded for that tree are forgotten, except the packed files, whose content
+        stays in the packs.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'tree'").fetchone()
+            if row is not None and row["value"] == tree:
+                return
+            if row is not None:
+                self.db.execute("DELETE FROM files WHERE pack IS NULL")
+                self.db.execute("DELETE FROM drives")
+                self.db.execute("DELETE FROM failed")
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('tree', ?)", (tree,))
+            self.db.commit()
+
+    def setSettings(self, settings):
+        """Tells the settings, as a string, that decide what is backed up of a file, e.g. the export formats.
+
+        If they changed since the last run, the page tokens are forgotten, so that the drives are
+        walked completely and unchanged files are backed up with the new settings as well.
+        """
+        with self.lock:
+            row = self.db.execute("SELECT value FROM meta WHERE key = 'settings'").fetchone()
+            if row is not None and row["value"] == settings:
+                return
+            self.db.execute("DELETE FROM drives")
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('settings', ?)", (settings,))
+            self.db.commit()
+
+    def lookup(self, fileId, exportMime=""):
+        with self.lock:
+            return self.db.execute("SELECT * FROM files WHERE id = ? AND exportMime = ?",
+                                   (fileId, exportMime)).fetchone()
+
+    def rows(self, fileId):
+        """All rows of a file, one per export mime type."""
+        with self.lock:
+            return self.db.execute("SELECT * FROM files WHERE id = ?", (fileId,)).fetchall()
+
+    def record(self, fileId, drive, path, file, exportMime="", backedUp=True):
+        """Records that path holds the file with the metadata file.
+
+        backedUp is False if the content was already there, e.g. after a local move. Where the
+        content was packed before is forgotten for backed up files, see setPacked.
+        A file recorded under another id, the target of a shortcut under the shortcut's id, is
+        remembered as its target, see shortcutsTo.
+        """
+        stamp = self.runStamp if backedUp else None
+        self.write("""
+            INSERT INTO files (id, exportMime, drive, path, mimeType, modifiedTime, md5Checksum, size, version,
+                               targetId, backedUp, seen)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, COALESCE(?, ''), ?)
+            ON CONFLICT (id, exportMime) DO UPDATE SET
+                drive = excluded.drive, path = excluded.path, mimeType = excluded.mimeType,
+                modifiedTime = excluded.modifiedTime, md5Checksum = excluded.md5Checksum, size = excluded.size,
+                version = excluded.version, targetId = excluded.targetId,
+                pack = CASE WHEN excluded.backedUp = '' THEN files.pack END,
+                packOffset = CASE WHEN excluded.backedUp = '' THEN files.packOffset END,
+                packLength = CASE WHEN excluded.backedUp = '' THEN files.packLength END,
+                backedUp = COALESCE(?, files.backedUp), seen = excluded.seen
+            """, (fileId, exportMime, drive, path, file.get("mimeType"), file.get("modifiedTime"),
+                  file.get("md5Checksum"), file.get("size"), file.get("version"), targetOf(fileId, file), stamp,
+                  self.runStamp, stamp))
+
+    def setPacked(self, fileId, exportMime, pack, offset, length):
+        """Records where in the packs the content of a file is."""
+        self.write("UPDATE files SET pack = ?, packOffset = ?, packLength = ? WHERE id = ? AND exportMime = ?",
+                   (pack, offset, length, fileId, exportMime))
+
+    def touch(self, fileId, exportMime="", file=None):
+        """Marks a file as found unchanged by this run."""
+        self.write("UPDATE files SET seen = ?, targetId = COALESCE(?, targetId) WHERE id = ? AND exportMime = ?",
+                   (self.runStamp, targetOf(fileId, file or {}), fileId, exportMime))
+
+    def claimed(self, row):
+        """Tells if another file was found at the path of row by this run."""
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM files WHERE drive = ? AND path = ? AND seen = ? "
+                                   "AND NOT (id = ? AND exportMime = ?) LIMIT 1",
+                                   (row["drive"], row["path"], self.runStamp, row["id"], row["exportMime"])
+                                   ).fetchone() is not None
+
+    def shortcutsTo(self, targetId):
+        """The rows of the copies of a file at the paths of shortcuts to it."""
+        with self.lock:
+            return self.db.execute("SELECT * FROM files WHERE targetId = ?", (targetId,)).fetchall()
+
+    def remove(self, fileId):
+        self.write("DELETE FROM files WHERE id = ?", (fileId,))
+
+    def movePrefix(self, drive, oldPrefix, newPrefix):
+        """Moves all paths below the folder oldPrefix to newPrefix."""
+        self.write("UPDATE files SET path = ? || substr(path, ?) WHERE drive = ? AND substr(path, 1, ?) = ?",
+                   (newPrefix, len(oldPrefix) + 1, drive, len(oldPrefix), oldPrefix))
+
+    def removePrefix(self, drive, prefix):
+        self.write("DELETE FROM files WHERE drive = ? AND substr(path, 1, ?) = ?", (drive, len(prefix), prefix))
+
+    def removeUnseen(self, drive):
+        """Forgets the files of a drive that this run did not find, called after a full walk."""
+        self.write("DELETE FROM files WHERE drive = ? AND seen < ?", (drive, self.runStamp))
+
+    def getToken(self, drive):
+        with self.lock:
+            row = self.db.execute("SELECT token FROM drives WHERE drive = ?", (drive,)).fetchone()
+        return row["token"] if row else None
+
+    def setToken(self, drive, token):
+        self.write("INSERT OR REPLACE INTO drives (drive, token) VALUES (?, ?)", (drive, token))
+
+    def getFailed(self, drive):
+        """Returns and forgets the files of a drive whose backup failed, as a dict id -> path."""
+        with self.lock:
+            rows = self.db.execute("SELECT id, path FROM failed WHERE drive = ?", (drive,)).fetchall()
+            self.db.execute("DELETE FROM failed WHERE drive = ?", (drive,))
+        return {row["id"]: row["path"] for row in rows}
+
+    def setFailed(self, fileId, drive, path):
+        self.write("INSERT OR REPLACE INTO failed (id, drive, path) VALUES (?, ?, ?)", (fileId, drive, path))
+
+    def changedSince(self, since):
+        """The files backed up (downloaded or exported) since the ISO timestamp since."""
+        with self.lock:
+            return self.db.execute("SELECT * FROM files WHERE backedUp >= ? ORDER BY drive, path",
+                                   (since,)).fetchall()
+
+
+def targetOf(fileId, file):
+    """The id of file if it is recorded under another id fileId, that of a shortcut to it."""
+    return file.get("id") if file.get("id") not in (None, fileId) else None
+
+
+def now():
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def main():
+    """Prints the files backed up since the given ISO date, by default in the last 24 hours."""
+    since = sys.argv[1] if len(sys.argv) > 1 else \
+        (datetime.now(timezone.utc) - timedelta(days=1)).isoformat(timespec="seconds")
+    if "T" not in since:
+        since = datetime.fromisoformat(since).astimezone(timezone.utc).isoformat(timespec="seconds")
+    manifest = Manifest("./bkup/.manifest.sqlite")
+    for row in manifest.changedSince(since):
+        print(row["backedUp"], row["modifiedTime"], row["path"])
+
+
+if __name__ == '__main__':
+    main()
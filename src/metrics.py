@@ -0,0 +1,243 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float("inf"))
+
+
+class Metrics:
+    """Counters, API latency histograms per endpoint and gauges like queue depths of a backup run.
+
+    Thread-safe. Metrics of worker processes are pickled and merged into the main process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        # e.g. skipped, downloaded, failed, bytes, retries <endpoint>
+        self.counters = Counter()
+        # endpoint -> [count per bucket of LATENCY_BUCKETS], endpoint -> total seconds
+        self.buckets = {}
+        self.seconds = Counter()
+        # name -> current value, name -> highest value
+        self.gauges = {}
+        self.peaks = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def observe(self, endpoint, seconds):
+        """Records the latency of an API request."""
+        with self.lock:
+            buckets = self.buckets.get(endpoint)
+            if buckets is None:
+                buckets = self.buckets[endpoint] = [0] * len(LATENCY_BUCKETS)
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+                    break
+            self.seconds[endpoint] += seconds
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+            self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def adjust(self, name, delta):
+        """Changes the gauge name by delta."""
+        with self.lock:
+            value = self.gauges.get(name, 0) + delta
+            self.gauges[name] = value
+            self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def merge(self, other):
+        with self.lock:
+            self.counters.update(other.counters)
+            for endpoint, buckets in other.buckets.items():
+                mine = self.buckets.setdefault(endpoint, [0] * len(LATENCY_BUCKETS))
+                for i, n in enumerate(buckets):
+                    mine[i] += n
+            self.seconds.update(other.seconds)
+            for name, value in other.peaks.items():
+                self.peaks[name] = max(self.peaks.get(name, value), value)
+
+    def calls(self):
+        with self.lock:
+            return sum(sum(buckets) for buckets in self.buckets.values())
+
+    def quantile(self, endpoint, q):
+        """Estimates the q quantile of the latency of endpoint from its histogram."""
+        buckets = self.buckets[endpoint]
+        rank = q * sum(buckets)
+        seen = 0
+        for bound, n in zip(LATENCY_BUCKETS, buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return LATENCY_BUCKETS[-1]
+
+    def report(self):
+        """The metrics as a JSON compatible dict."""
+        with self.lock:
+            endpoints = {}
+            for endpoint, buckets in sorted(self.buckets.items()):
+                calls = sum(buckets)
+                endpoints[endpoint] = {
+                    "calls": calls,
+                    "seconds": round(self.seconds[endpoint], 3),
+                    "mean": round(self.seconds[endpoint] / calls, 4) if calls else 0,
+                    "p50": self.quantile(endpoint, 0.5),
+                    "p95": self.quantile(endpoint, 0.95),
+                    "buckets": {str(bound): n for bound, n in zip(LATENCY_BUCKETS, buckets)},
+                }
+            return {
+                "start": self.start,
+                "elapsed": round(time.time() - self.start, 3),
+                "counters": dict(sorted(self.counters.items())),
+                "endpoints": endpoints,
+                "gauges": {name: {"value": self.gauges.get(name, 0), "peak": peak}
+                           for name, peak in sorted(self.peaks.items())},
+            }
+
+    def writeJson(self, path, **extra):
+        report = self.report()
+        report.update(extra)
+        writeAtomic(path, json.dumps(report, indent=2, default=str))
+
+    def writePrometheus(self, path, prefix="gdrive_backup"):
+        """Writes the metrics in the Prometheus text format, e.g. for the textfile collector of node_exporter."""
+        report = self.report()
+        lines = [f"# TYPE {prefix}_events_total counter"]
+        for name, n in report["counters"].items():
+            lines.append(f'{prefix}_events_total{{name="{name}"}} {n}')
+        lines.append(f"# TYPE {prefix}_api_latency_seconds histogram")
+        for endpoint, info in report["endpoints"].items():
+            total = 0
+            for bound, n in info["buckets"].items():
+                total += n
+                le = "+Inf" if bound == "inf" else bound
+                lines.append(f'{prefix}_api_latency_seconds_bucket{{endpoint="{endpoint}",le="{le}"}} {total}')
+            lines.append(f'{prefix}_api_latency_seconds_sum{{endpoint="{endpoint}"}} {info["seconds"]}')
+            lines.append(f'{prefix}_api_latency_seconds_count{{endpoint="{endpoint}"}} {info["calls"]}')
+        lines.append(f"# TYPE {prefix}_gauge_peak gauge")
+        for name, info in report["gauges"].items():
+            lines.append(f'{prefix}_gauge_peak{{name="{name}"}} {info["peak"]}')
+        lines.append(f"# TYPE {prefix}_elapsed_seconds gauge")
+        lines.append(f"{prefix}_elapsed_seconds {report['elapsed']}")
+        writeAtomic(path, "\n".join(lines) + "\n")
+
+
+def writeAtomic(path, text):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmpPath = path + ".tmp"
+    with open(tmpPath, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmpPath, path)
+
+
+class Progress:
+    """Rewrites a progress line on stderr every `interval` seconds while the backup runs.
+
+    Only if stderr is a terminal, log files get the summary at the end instead.
+    """
+
+    DONE = ("skipped", "downloaded", "exported", "linked", "moved", "removed", "excluded", "failed")
+
+    def __init__(self, metrics, interval=1.0):
+        self.metrics = metrics
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def __enter__(self):
+        if sys.stderr.isatty():
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.thread is not None:
+            self.stopped.set()
+            self.thread.join()
+            sys.stderr.write("\n")
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            sys.stderr.write("\r" + self.line() + "\x1b[K")
+            sys.stderr.flush()
+
+    def line(self):
+        m = self.metrics
+        with m.lock:
+            counters = m.counters.copy()
+            queued = m.gauges.get("downloads queued", 0)
+        elapsed = max(time.time() - m.start, 0.001)
+        files = sum(counters[name] for name in self.DONE)
+        retries = sum(n for name, n in counters.items() if name.startswith("retries"))
+        return (f"{int(elapsed)}s {files} files ({files / elapsed:.0f}/s): "
+                + ", ".join(f"{name} {counters[name]}" for name in self.DONE if counters[name])
+                + f" | {counters['bytes'] / 1e6:.1f} MB ({counters['bytes'] / 1e6 / elapsed:.1f} MB/s)"
+                + f" | queued {queued} | calls {m.calls()} retries {retries}")
+
+
+class Profiler:
+    """Profiles the code run in its with block: "cprofile" profiles the calling thread, that is the
+    listing and the skip decisions, "tracemalloc" the memory allocations of all threads.
+
+    The result is written to path, pstats data or the top allocations as text, and summarized
+    by summary().
+    """
+
+    def __init__(self, kind, path, top=25):
+        self.kind = kind
+        self.path = path
+        self.top = top
+        self.profile = None
+        self.text = ""
+
+    def __enter__(self):
+        if self.kind == "cprofile":
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        elif self.kind == "tracemalloc":
+            tracemalloc.start(10)
+        elif self.kind:
+            raise ValueError(f"unknown profiler {self.kind}")
+        return self
+
+    def __exit__(self, *exc):
+        if self.kind == "cprofile":
+            self.profile.disable()
+            self.profile.dump_stats(self.path)
+            out = io.StringIO()
+            pstats.Stats(self.profile, stream=out).sort_stats("cumulative").print_stats(self.top)
+            self.text = out.getvalue()
+        elif self.kind == "tracemalloc":
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = [f"current {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB"]
+            lines += [str(stat) for stat in snapshot.statistics("lineno")[:self.top]]
+            self.text = "\n".join(lines) + "\n"
+            writeAtomic(self.path, self.text)
+
+    def summary(self):
+        return self.text
@@ -0,0 +1,63 @@
+import hashlib
+import os
+import shutil
+
+
+class ObjectStore:
+    """Content-addressed store of file contents, keyed by their md5 checksum.
+
+    Blobs live in <root>/<first 2 hex digits>/<md5>, the visible backup tree consists of
+    hardlinks to them (copies if the filesystem cannot link).
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, md5):
+        return os.path.join(self.root, md5[:2], md5)
+
+    def has(self, md5):
+        return md5 is not None and os.path.exists(self.path(md5))
+
+    def add(self, tmpPath, md5, mtime):
+        """Moves the file tmpPath into the store under md5, drops it if the blob exists already."""
+        objPath = self.path(md5)
+        if os.path.exists(objPath):
+            os.remove(tmpPath)
+            return objPath
+        os.makedirs(os.path.dirname(objPath), exist_ok=True)
+        os.utime(tmpPath, (mtime, mtime))
+        os.replace(tmpPath, objPath)
+        return objPath
+
+    def link(self, md5, targetPath):
+        """Makes targetPath a link to the blob md5, atomically replacing an existing file."""
+        tmpPath = targetPath + ".lnk"
+        if os.path.lexists(tmpPath):
+            os.remove(tmpPath)
+        try:
+            os.link(self.path(md5), tmpPath)
+        except OSError:
+            # different filesystem or too many links
+            shutil.copy2(self.path(md5), tmpPath)
+        os.replace(tmpPath, targetPath)
+
+    def prune(self):
+        """Removes the blobs no longer linked from the backup tree, returns their number."""
+        removed = 0
+        for dirPath, _, names in os.walk(self.root):
+            for name in names:
+                objPath = os.path.join(dirPath, name)
+                if os.stat(objPath).st_nlink == 1:
+                    os.remove(objPath)
+                    removed += 1
+        return removed
+
+
+def md5File(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
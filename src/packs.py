@@ -0,0 +1,171 @@
+import glob
+import json
+import os
+import shutil
+import sys
+import threading
+from datetime import datetime
+
+from manifest import Manifest
+
+
+class PackWriter:
+    """Appends files as zstd frames to large pack files in packDir.
+
+    Every file is one independently compressed frame, so that a single file can be restored by
+    seeking to its offset, see restoreFile. Every pack has an append-only index <name>-<number>.idx
+    with a JSON line per file, see readIndex, the manifest only knows the packed files of the current
+    tree. A pack is never changed once written: every run (and every worker process) starts new
+    packs named <name>-<number>.zpack, a pack is closed when it grows beyond maxSize bytes.
+    """
+
+    def __init__(self, packDir, name, level=3, maxSize=1024 ** 3):
+        import zstandard
+        self.zstandard = zstandard
+        self.packDir = packDir
+        self.name = name
+        self.level = level
+        self.maxSize = maxSize
+        self.number = 0
+        self.pack = None
+        self.file = None
+        self.index = None
+        self.lock = threading.Lock()
+        os.makedirs(os.path.join(packDir, "tmp"), exist_ok=True)
+
+    def tmpPath(self, name):
+        """A path for a download that is added to a pack later."""
+        return os.path.join(self.packDir, "tmp", name)
+
+    def add(self, path, entry=None):
+        """Appends the file path to the current pack, returns its pack, offset and length in the pack.
+
+        The dict entry, the metadata of the file, is added with them to the index of the pack.
+        The file is compressed next to it first, so that other threads can append meanwhile.
+        """
+        zstPath = path + ".zst"
+        cctx = self.zstandard.ZstdCompressor(level=self.level, write_checksum=True)
+        with open(path, "rb") as src, open(zstPath, "wb") as dst:
+            cctx.copy_stream(src, dst, size=os.path.getsize(path))
+        try:
+            with self.lock:
+                if self.file is None or self.file.tell() >= self.maxSize:
+                    self.nextPack()
+                offset = self.file.tell()
+                with open(zstPath, "rb") as src:
+                    shutil.copyfileobj(src, self.file, 1024 * 1024)
+                length = self.file.tell() - offset
+                pack = self.pack
+                # the index never points to data not yet written
+                self.file.flush()
+                self.index.write(json.dumps(dict(entry or {}, pack=pack, packOffset=offset, packLength=length)) + "\n")
+                self.index.flush()
+        finally:
+            os.remove(zstPath)
+        return pack, offset, length
+
+    def nextPack(self):
+        self.closePack()
+        while True:
+            self.number += 1
+            self.pack = f"{self.name}-{self.number:03d}.zpack"
+            if not os.path.exists(os.path.join(self.packDir, self.pack)):
+                break
+        self.file = open(os.path.join(self.packDir, self.pack), "ab")
+        self.index = open(os.path.join(self.packDir, indexName(self.pack)), "a")
+
+    def closePack(self):
+        if self.file is not None:
+            for f in (self.file, self.index):
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+            self.file = None
+            self.index = None
+
+    def close(self):
+        with self.lock:
+            self.closePack()
+
+
+def packName(runStamp):
+    """The name of the packs of this run and process."""
+    return runStamp.replace(":", "").replace("+0000", "Z") + f"-{os.getpid()}"
+
+
+def indexName(pack):
+    return pack[:-len(".zpack")] + ".idx"
+
+
+def readIndex(packDir):
+    """The entries of the indexes of all packs, oldest first.
+
+    Every entry is a dict with the id, exportMime, drive, path, modifiedTime, md5Checksum and size
+    of a packed file and its pack, packOffset and packLength. A line cut off by a crash is skipped.
+    """
+    for indexPath in sorted(glob.glob(os.path.join(packDir, "*.idx"))):
+        with open(indexPath) as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    pass
+
+
+def restoreFile(packDir, row, targetPath):
+    """Restores the file of the manifest row or index entry from its pack to targetPath."""
+    import zstandard
+    os.makedirs(os.path.dirname(targetPath) or ".", exist_ok=True)
+    with open(os.path.join(packDir, row["pack"]), "rb") as pack, open(targetPath + ".part", "wb") as out:
+        pack.seek(row["packOffset"])
+        decompressor = zstandard.ZstdDecompressor().decompressobj()
+        remaining = row["packLength"]
+        while remaining > 0:
+            chunk = pack.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                raise ValueError(f"{row['pack']} is truncated")
+            remaining -= len(chunk)
+            out.write(decompressor.decompress(chunk))
+        if not decompressor.eof:
+            raise ValueError(f"{row['path']} is incomplete in {row['pack']}")
+    if row["modifiedTime"]:
+        mtime = datetime.fromisoformat(row["modifiedTime"].replace("Z", "+00:00")).timestamp()
+        os.utime(targetPath + ".part", (mtime, mtime))
+    os.replace(targetPath + ".part", targetPath)
+
+
+def main():
+    """Restores the files whose path starts with the given prefix (all files by default) from the packs.
+
+    python src/packs.py [--all] [prefix [targetDir]]
+
+    The files of the backup tree are restored at their path in the manifest. With --all also the
+    files no longer in it, e.g. trashed or deleted ones, are restored, at the path they were packed at.
+    """
+    args = [arg for arg in sys.argv[1:] if arg != "--all"]
+    restoreAll = "--all" in sys.argv[1:]
+    prefix = args[0] if args else ""
+    targetDir = args[1] if len(args) > 1 else "./restore"
+    manifest = Manifest("./bkup/.manifest.sqlite")
+    # (id, exportMime) -> the entry of the newest version of the file
+    latest = {}
+    for entry in readIndex("./bkup/packs"):
+        latest[(entry["id"], entry["exportMime"])] = entry
+    n = 0
+    for entry in sorted(latest.values(), key=lambda e: (e["pack"], e["packOffset"])):
+        row = manifest.lookup(entry["id"], entry["exportMime"])
+        if row is not None and (row["pack"], row["packOffset"]) == (entry["pack"], entry["packOffset"]):
+            # moved since it was packed
+            entry["path"] = row["path"]
+        elif not restoreAll:
+            continue
+        if not entry["path"].startswith(prefix):
+            continue
+        print(entry["path"])
+        restoreFile("./bkup/packs", entry, os.path.join(targetDir, entry["path"]))
+        n += 1
+    print("Restored", n, "files")
+
+
+if __name__ == '__main__':
+    main()
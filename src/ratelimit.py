@@ -0,0 +1,41 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket:
+    """Thread-safe token bucket, allows `rate` requests per second with bursts of up to `burst`."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Takes a token if one is available, else returns the seconds until there is one."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self):
+        """Blocks until a token is available and takes it."""
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    async def acquireAsync(self):
+        """Like acquire, but waits without blocking the event loop."""
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
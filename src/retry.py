@@ -0,0 +1,162 @@
+import random
+import socket
+import threading
+import time
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+# HTTP status codes worth retrying, 403 only with a rate limit reason
+RETRYABLE_STATUS = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = (b"userRateLimitExceeded", b"rateLimitExceeded", b"backendError")
+
+
+def retryDelay(attempt, retryAfter=None, baseDelay=1.0, maxDelay=64.0):
+    """Seconds to wait before retry number attempt (0-based): exponential backoff with full
+    jitter, but at least what the server asked for in Retry-After."""
+    delay = random.uniform(0, min(maxDelay, baseDelay * 2 ** attempt))
+    if retryAfter:
+        try:
+            delay = max(delay, float(retryAfter))
+        except ValueError:
+            pass
+    return delay
+
+
+def isThrottled(status, content=b""):
+    return status == 429 or (status == 403 and any(r in (content or b"") for r in RATE_LIMIT_REASONS))
+
+
+def isRetryable(status, content=b""):
+    return status in RETRYABLE_STATUS or isThrottled(status, content)
+
+
+class AdaptiveLimiter:
+    """Limits the number of concurrent requests, additive increase / multiplicative decrease.
+
+    The limit is halved after a throttling response and grows by one after `increaseAfter`
+    successful requests, up to maxLimit.
+    """
+
+    def __init__(self, maxLimit, increaseAfter=20):
+        self.maxLimit = maxLimit
+        self.limit = maxLimit
+        self.increaseAfter = increaseAfter
+        self.active = 0
+        self.successes = 0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.active >= self.limit:
+                self.cond.wait()
+            self.active += 1
+
+    def release(self, throttled):
+        with self.cond:
+            self.active -= 1
+            if throttled:
+                self.limit = max(1, self.limit // 2)
+                self.successes = 0
+            else:
+                self.successes += 1
+                if self.successes >= self.increaseAfter and self.limit < self.maxLimit:
+                    self.limit += 1
+                    self.successes = 0
+            self.cond.notify_all()
+
+
+class Executor:
+    """Executes Drive, Calendar and Admin API requests with retries.
+
+    Rate limit (403/429) and server errors (5xx) as well as network errors are retried up to
+    maxRetries times with exponential backoff and jitter, honoring Retry-After. Requests take a
+    token from the optional token bucket and a slot from the AdaptiveLimiter, which lowers the
+    concurrency after throttling responses. count(name, n) is called for every retry with the
+    name "retries <endpoint>", observe(endpoint, seconds) with the duration of every attempt.
+    """
+
+    def __init__(self, maxConcurrency, bucket=None, maxRetries=8, count=None, observe=None):
+        self.limiter = AdaptiveLimiter(maxConcurrency)
+        self.bucket = bucket
+        self.maxRetries = maxRetries
+        self.count = count or (lambda name, n=1: None)
+        self.observe = observe or (lambda endpoint, seconds: None)
+
+    def execute(self, request, endpoint=None):
+        """Executes a googleapiclient HttpRequest, returns its result."""
+        return self.call(request.execute, endpoint or getattr(request, "methodId", None) or "request")
+
+    def call(self, fn, endpoint):
+        """Calls fn() until it succeeds, retrying retryable errors."""
+        attempt = 0
+        while True:
+            if self.bucket is not None:
+                self.bucket.acquire()
+            self.limiter.acquire()
+            throttled = False
+            start = time.monotonic()
+            try:
+                return fn()
+            except HttpError as e:
+                status = e.resp.status
+                throttled = isThrottled(status, e.content)
+                if not isRetryable(status, e.content) or attempt >= self.maxRetries:
+                    raise
+                delay = retryDelay(attempt, e.resp.get("retry-after"))
+            except (socket.timeout, ConnectionError, httplib2.HttpLib2Error):
+                if attempt >= self.maxRetries:
+                    raise
+                delay = retryDelay(attempt)
+            finally:
+                self.limiter.release(throttled)
+                self.observe(endpoint, time.monotonic() - start)
+            self.count(f"retries {endpoint}")
+            time.sleep(delay)
+            attempt += 1
+
+    def executeBatch(self, newBatch, requests, batchSize=100, maxRetries=5):
+        """Executes many requests with batch requests, returns the dicts id -> response and id -> error.
+
+        newBatch(callback) creates a BatchHttpRequest, requests maps request ids to functions
+        creating the requests. Sub-requests that failed with a rate limit or server error are
+        retried in new batches, those still failing after maxRetries retries are errors.
+        """
+        res = {}
+        errors = {}
+        todo = list(requests)
+        for attempt in range(maxRetries + 1):
+            failed = []
+
+            def callback(requestId, response, exception):
+                if exception is None:
+                    res[requestId] = response
+                elif isinstance(exception, HttpError) and isRetryable(exception.resp.status, exception.content):
+                    failed.append(requestId)
+                    errors[requestId] = exception
+                else:
+                    errors[requestId] = exception
+
+            for i in range(0, len(todo), batchSize):
+                chunk = todo[i:i + batchSize]
+                batch = newBatch(callback)
+                for requestId in chunk:
+                    batch.add(requests[requestId](), request_id=requestId)
+                # every sub-request counts against the quota, the batch itself takes one token in call
+                if self.bucket is not None:
+                    for _ in chunk[1:]:
+                        self.bucket.acquire()
+                try:
+                    self.call(batch.execute, "batch")
+                except (HttpError, OSError, httplib2.HttpLib2Error) as e:
+                    for requestId in chunk:
+                        if requestId not in res and requestId not in failed:
+                            failed.append(requestId)
+                            errors[requestId] = e
+            if not failed or attempt == maxRetries:
+                return res, errors
+            for requestId in failed:
+                del errors[requestId]
+            self.count("retries batch", len(failed))
+            time.sleep(retryDelay(attempt))
+            todo = failed
@@ -0,0 +1,144 @@
+import re
+from datetime import datetime, timezone
+
+FOLDER = "application/vnd.google-apps.folder"
+SHORTCUT = "application/vnd.google-apps.shortcut"
+
+
+def compilePattern(pattern):
+    """Compiles a path pattern, "re:<regex>" or a glob where "*" and "?" match within a path
+    segment and "**" across segments, e.g. "MyDrive/Videos/**" or "**/node_modules/".
+
+    Globs match the whole path, regexes anywhere in it.
+    """
+    if pattern.startswith("re:"):
+        return re.compile(pattern[3:])
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return re.compile("^" + regex + "$")
+
+
+def literalPrefix(pattern):
+    """The part of a glob before its first wildcard, None for a regex."""
+    if pattern.startswith("re:"):
+        return None
+    return re.split(r"[*?]", pattern, 1)[0]
+
+
+class Rules:
+    """Decides which files and folders are backed up.
+
+    Paths are relative to ./bkup and start with the drive name, folders end with "/". A file is
+    backed up if it or one of its folders matches an include pattern (all files if there are
+    none), neither matches an exclude pattern, its mime type is not excluded, and it is not
+    larger than maxSize nor older than modifiedSince. Trashed files are never backed up.
+    As much as possible is evaluated by Drive, see query, the rest by keep and walkDir.
+    """
+
+    def __init__(self, include=(), exclude=(), excludeMimeTypes=(), maxSize=None, modifiedSince=None,
+                 shortcuts=True):
+        self.include = [compilePattern(p) for p in include]
+        self.includePrefixes = [literalPrefix(p) for p in include]
+        self.exclude = [compilePattern(p) for p in exclude]
+        # "video/*" excludes all video types, "application/vnd.google-apps.*" all Google Docs
+        self.excludeMimeTypes = list(excludeMimeTypes)
+        self.maxSize = maxSize
+        self.modifiedSince = None
+        if modifiedSince:
+            since = datetime.fromisoformat(modifiedSince)
+            if since.tzinfo is None:
+                since = since.replace(tzinfo=timezone.utc)
+            self.modifiedSince = since
+        self.shortcuts = shortcuts
+        # folder path -> excluded, folders are checked for every file below them
+        self.dirs = {}
+
+    @property
+    def selective(self):
+        """True if the rules leave out anything but trashed files."""
+        return bool(self.include or self.exclude or self.excludeMimeTypes or self.maxSize is not None
+                    or self.modifiedSince or not self.shortcuts)
+
+    @property
+    def prunes(self):
+        """True if the path rules can leave out whole folders, see walkDir."""
+        return bool(self.include or self.exclude)
+
+    def query(self, q=None):
+        """Adds the rules that Drive can evaluate to the files().list query q.
+
+        Folders and shortcuts are listed regardless of their modifiedTime, files below them may be newer.
+        """
+        terms = [q] if q else []
+        terms.append("trashed = false")
+        for mimeType in self.excludeMimeTypes:
+            if mimeType.endswith("*"):
+                # contains matches anywhere, keep also folders and shortcuts listed
+                terms.append("(" + " or ".join([f"not mimeType contains '{mimeType[:-1]}'"] +
+                                               [f"mimeType = '{m}'" for m in (FOLDER, SHORTCUT)
+                                                if m.startswith(mimeType[:-1])]) + ")")
+            else:
+                terms.append(f"mimeType != '{mimeType}'")
+        if not self.shortcuts:
+            terms.append(f"mimeType != '{SHORTCUT}'")
+        if self.modifiedSince:
+            since = self.modifiedSince.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S")
+            terms.append(f"(modifiedTime > '{since}' or mimeType = '{FOLDER}' or mimeType = '{SHORTCUT}')")
+        return " and ".join(terms)
+
+    def matches(self, patterns, path):
+        return any(p.search(path) or (path.endswith("/") and p.search(path[:-1])) for p in patterns)
+
+    def dirExcluded(self, path):
+        excluded = self.dirs.get(path)
+        if excluded is None:
+            excluded = self.matches(self.exclude, path)
+            self.dirs[path] = excluded
+        return excluded
+
+    def walkDir(self, path):
+        """Tells if the folder path is listed, that is if it can hold files that are backed up."""
+        if self.dirExcluded(path):
+            return False
+        if not self.include:
+            return True
+        return any(prefix is None or prefix.startswith(path) or path.startswith(prefix)
+                   for prefix in self.includePrefixes) or self.matches(self.include, path)
+
+    def pathIncluded(self, path):
+        folders = [path[:i + 1] for i, c in enumerate(path[:-1]) if c == "/"]
+        if any(self.dirExcluded(folder) for folder in folders) or self.matches(self.exclude, path):
+            return False
+        return not self.include or any(self.matches(self.include, p) for p in folders + [path])
+
+    def keep(self, file, path):
+        """Tells if file is backed up at path, also for files that were not listed with query, e.g. changes."""
+        if file.get("trashed") or not self.pathIncluded(path):
+            return False
+        mimeType = file["mimeType"]
+        if mimeType == SHORTCUT:
+            # the target is checked when it is fetched
+            return self.shortcuts
+        if any(mimeType == m or (m.endswith("*") and mimeType.startswith(m[:-1])) for m in self.excludeMimeTypes):
+            return False
+        if self.maxSize is not None and int(file.get("size", 0)) > self.maxSize:
+            return False
+        if self.modifiedSince and datetime.fromisoformat(file["modifiedTime"]) <= self.modifiedSince:
+            return False
+        return True
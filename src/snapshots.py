@@ -0,0 +1,91 @@
+import os
+import shutil
+from datetime import date
+
+
+def listSnapshots(snapshotDir):
+    """The snapshot names (ISO dates) in snapshotDir, oldest first."""
+    if not os.path.isdir(snapshotDir):
+        return []
+    res = []
+    for name in os.listdir(snapshotDir):
+        try:
+            date.fromisoformat(name)
+        except ValueError:
+            continue
+        res.append(name)
+    res.sort()
+    return res
+
+
+def createSnapshot(snapshotDir, name):
+    """Creates the snapshot snapshotDir/name and returns its path.
+
+    The new snapshot starts as a copy of the previous one made of hardlinks (rsync --link-dest
+    style), so it costs no disk space for unchanged files. The backup replaces changed files
+    with new files instead of writing into them, which leaves the older snapshots intact.
+    Partial downloads are moved instead of linked, as they are appended to. A file that cannot be
+    linked is copied.
+    If the snapshot exists already, e.g. from an earlier run on the same day, it is reused.
+    """
+    newPath = os.path.join(snapshotDir, name)
+    previous = [s for s in listSnapshots(snapshotDir) if s < name]
+    if os.path.isdir(newPath) or not previous:
+        os.makedirs(newPath, exist_ok=True)
+        return newPath
+    prevPath = os.path.join(snapshotDir, previous[-1])
+    tmpPath = newPath + ".tmp"
+    shutil.rmtree(tmpPath, ignore_errors=True)
+    for dirPath, dirNames, fileNames in os.walk(prevPath):
+        relDir = os.path.relpath(dirPath, prevPath)
+        os.makedirs(os.path.join(tmpPath, relDir), exist_ok=True)
+        for fileName in fileNames:
+            src = os.path.join(dirPath, fileName)
+            dst = os.path.join(tmpPath, relDir, fileName)
+            if fileName.endswith(".part") or fileName.endswith(".part.json"):
+                os.replace(src, dst)
+            else:
+                try:
+                    os.link(src, dst)
+                except OSError:
+                    # too many links to a file, e.g. one linked from many snapshots and a CAS blob
+                    shutil.copy2(src, dst)
+    # a snapshot becomes visible only when complete
+    os.replace(tmpPath, newPath)
+    return newPath
+
+
+def setLatest(snapshotDir, name):
+    """Points the symlink snapshotDir/latest to the snapshot name."""
+    linkPath = os.path.join(snapshotDir, "latest")
+    tmpPath = linkPath + ".tmp"
+    if os.path.lexists(tmpPath):
+        os.remove(tmpPath)
+    os.symlink(name, tmpPath)
+    os.replace(tmpPath, linkPath)
+
+
+def pruneSnapshots(snapshotDir, daily, weekly, monthly):
+    """Removes the snapshots not kept by the retention policy, returns the removed names.
+
+    Kept are the newest snapshot of each of the last `daily` days, `weekly` ISO weeks and
+    `monthly` months that have snapshots. The newest snapshot is always kept.
+    """
+    names = listSnapshots(snapshotDir)
+    keep = set(names[-1:])
+    for count, bucket in ((daily, lambda d: d),
+                          (weekly, lambda d: d.isocalendar()[:2]),
+                          (monthly, lambda d: (d.year, d.month))):
+        seen = set()
+        for name in reversed(names):
+            b = bucket(date.fromisoformat(name))
+            if b in seen:
+                continue
+            if len(seen) >= count:
+                break
+            seen.add(b)
+            keep.add(name)
+    removed = [name for name in names if name not in keep]
+    for name in removed:
+        shutil.rmtree(os.path.join(snapshotDir, name))
+    return removed